@@ -1,68 +1,386 @@
+import cProfile
+import multiprocessing
 import random
 import sys
+import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from utils import Vector2
-from quantik import Game, Piece
+from board import Board, FULL_MASK, LINE_MASKS, SHAPE_COUNT, SQUARE_COUNT
+from quantik import Game, Piece, Player, SHAPES, SQUARE_VECTORS
+from transposition import TranspositionTable, EXACT, LOWER_BOUND, UPPER_BOUND
+from symmetry import canonical_key, transform_move, untransform_move
+from tablebase import WIN, LOSS
+
+# Score of a win on the first ply, wins further down the tree score one less per ply
+WIN_SCORE = 100
+# Every player owns one piece of each shape, so no game lasts longer than this
+MAX_DEPTH = 2 * SHAPE_COUNT
+# Remaining depth from which table entries are shared between symmetric
+# positions, below it canonicalizing costs more than searching
+CANONICAL_MIN_DEPTH = 3
+# Remaining depth from which moves are ordered, closer to the horizon
+# ordering costs more than it saves
+ORDER_MIN_DEPTH = 3
+
+# Win scores depend on the ply they're found at, the table stores them
+# relative to the position instead so they can be reused at any ply
+def score_to_table(score, ply):
+  if score > WIN_SCORE - MAX_DEPTH - 1:
+    return score + ply
+  if score < -(WIN_SCORE - MAX_DEPTH - 1):
+    return score - ply
+  return score
+
+def score_from_table(score, ply):
+  if score > WIN_SCORE - MAX_DEPTH - 1:
+    return score - ply
+  if score < -(WIN_SCORE - MAX_DEPTH - 1):
+    return score + ply
+  return score
+
+# Score of the position for the player to move at ply when the search
+# stops there. Lines with three shapes and a single empty square decide it:
+# the player to move completing one wins on the next ply, two the opponent
+# can complete on different squares, or one on a square the player to move
+# can't block, lose on the one after. Otherwise every empty square only the
+# opponent can place a shape on counts for the player to move, and every one
+# only the player to move can use counts against it. A player running out of
+# squares ends the game in a stale mate, which is a draw, and bench.py
+# --accuracy picks full search moves more often with this sign than with
+# the opposite one.
+def evaluate(board, ply):
+  turn = board.turn
+  pieces = board.pieces[turn]
+  opponent = board.pieces[turn ^ 1]
+  occupied = board.occupied
+  shapes = board.shapes
+  forbidden = board.forbidden
+
+  # Squares each player can place one of its shapes on
+  reachable = 0
+  opponent_reachable = 0
+  for shape in range(SHAPE_COUNT):
+    squares = FULL_MASK & ~(occupied | forbidden[shape])
+    if not pieces[shape]:
+      reachable |= squares
+    if not opponent[shape]:
+      opponent_reachable |= squares
+  if not reachable:
+    return 0
+
+  # Squares on which the opponent completes a line
+  threats = 0
+  for line in LINE_MASKS:
+    empty = line & ~occupied
+    if not empty or empty & (empty - 1):
+      continue
+
+    for shape in range(SHAPE_COUNT):
+      if not shapes[shape] & line:
+        break
+    if forbidden[shape] & empty:
+      continue
+    if not pieces[shape]:
+      return WIN_SCORE - ply
+    if not opponent[shape]:
+      threats |= empty
+
+  if threats & (threats - 1) or threats & ~reachable:
+    return -(WIN_SCORE - ply - 1)
+  return bin(opponent_reachable & ~reachable).count("1") - bin(reachable & ~opponent_reachable).count("1")
+
+# Forked workers don't re-import the main module, which for main.py would
+# open another window
+def worker_context():
+  if "fork" in multiprocessing.get_all_start_methods():
+    return multiprocessing.get_context("fork")
+  return None
+
+# Process pools shared by every AI, by worker count
+_executors = {}
+
+def process_pool(workers):
+  if workers not in _executors:
+    _executors[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=worker_context())
+  return _executors[workers]
+
+# The AI of a worker process and the (encoding, depth, evaluation) of the
+# root search it belongs to. Its transposition table is shared by the root
+# moves of that search only, an entry from another root or depth was
+# searched to a different depth and would change the exact scores.
+_worker_ai = None
+_worker_search = None
+
+# Exact score of a root move and the nodes it took, run in a worker process.
+# The position is passed as Board.encode() to keep the payload small.
+def score_root_move(encoding, move, depth, evaluation=True):
+  global _worker_ai, _worker_search
+  if _worker_search != (encoding, depth, evaluation):
+    _worker_ai = AI(None, depth=depth, evaluation=evaluation)
+    _worker_search = (encoding, depth, evaluation)
+
+  board = Board.decode(encoding)
+  shape, square = move
+  if board.winning_line(shape, square):
+    return WIN_SCORE - 1, 0
+
+  board.place(board.turn, shape, square)
+  _worker_ai.nodes = 0
+  score = -_worker_ai.negamax(board, depth - 1, 2, -sys.maxsize, sys.maxsize)
+  return score, _worker_ai.nodes
+
+class SearchTimeout(Exception):
+  pass
+
+# What the last calculate_move_scores of an AI did. Nodes searched by worker
+# processes are counted in nodes only. The times are in milliseconds, the
+# split between move generation, evaluation and making moves is only
+# measured for AIs created with timed=True.
+class SearchStats:
+  def __init__(self):
+    self.nodes = 0
+    # Positions searched n moves after the root, by n
+    self.nodes_per_ply = [0] * (MAX_DEPTH + 1)
+    # Moves not searched because an earlier move was good enough
+    self.cutoffs = 0
+    # Positions answered by the transposition table without searching
+    self.table_cutoffs = 0
+    self.table_hits = 0
+    self.table_misses = 0
+    self.tablebase_hits = 0
+    self.book_hits = 0
+    self.elapsed_ms = 0.0
+    # Board.legal_moves
+    self.movegen_ms = 0.0
+    # Board.winning_line
+    self.eval_ms = 0.0
+    # Board.copy, place and remove, which replaced cloning the game
+    self.clone_ms = 0.0
+    self.iterations = []
+
+  # Most moves after the root that were searched
+  @property
+  def peak_depth(self):
+    for ply in range(len(self.nodes_per_ply) - 1, -1, -1):
+      if self.nodes_per_ply[ply]:
+        return ply
+    return 0
+
+  def as_dict(self):
+    return {
+      "nodes": self.nodes,
+      "nodes_per_ply": self.nodes_per_ply[:self.peak_depth + 1],
+      "peak_depth": self.peak_depth,
+      "cutoffs": self.cutoffs,
+      "table_cutoffs": self.table_cutoffs,
+      "table_hits": self.table_hits,
+      "table_misses": self.table_misses,
+      "tablebase_hits": self.tablebase_hits,
+      "book_hits": self.book_hits,
+      "elapsed_ms": self.elapsed_ms,
+      "movegen_ms": self.movegen_ms,
+      "eval_ms": self.eval_ms,
+      "clone_ms": self.clone_ms,
+      "iterations": self.iterations
+    }
+
+# Board that adds the time spent in its methods to a SearchStats. Reading
+# the clock this often slows the search down, so it's only used on request.
+class TimedBoard(Board):
+  __slots__ = ("stats",)
+
+  def __init__(self, board, stats):
+    copy = Board.copy(board)
+    for name in Board.__slots__:
+      setattr(self, name, getattr(copy, name))
+    self.stats = stats
+
+  def copy(self):
+    start = time.perf_counter()
+    board = TimedBoard(self, self.stats)
+    self.stats.clone_ms += (time.perf_counter() - start) * 1000
+    return board
+
+  def legal_moves(self):
+    start = time.perf_counter()
+    moves = Board.legal_moves(self)
+    self.stats.movegen_ms += (time.perf_counter() - start) * 1000
+    return moves
+
+  def winning_line(self, shape, square):
+    start = time.perf_counter()
+    line = Board.winning_line(self, shape, square)
+    self.stats.eval_ms += (time.perf_counter() - start) * 1000
+    return line
+
+  def place(self, player, shape, square):
+    start = time.perf_counter()
+    Board.place(self, player, shape, square)
+    self.stats.clone_ms += (time.perf_counter() - start) * 1000
+
+  def remove(self, player, shape, square):
+    start = time.perf_counter()
+    Board.remove(self, player, shape, square)
+    self.stats.clone_ms += (time.perf_counter() - start) * 1000
 
 class AI:
   game: Game
+  player: Player
+  depth: int
+  search: str
+  table: TranspositionTable
 
-  def __init__(self, game):
+  # search is either "negamax" (alpha-beta) or "minimax" (exhaustive reference),
+  # a depth of None searches until the end of the game. Pass a table to share
+  # transpositions between AI instances. With a tablebase.Tablebase negamax
+  # looks up the positions it covers instead of searching them, a book.Book
+  # gives the best moves of the first moves of the game. A time_budget
+  # in milliseconds makes negamax deepen iteratively, up to depth, until it
+  # runs out. Otherwise workers spreads the root moves over that many
+  # processes. Ties between the best moves are broken with rng. timed
+  # measures where the search spends its time in stats, and a profile path
+  # writes the cProfile stats of every calculation to that file. ordering
+  # can be turned off to measure what move ordering saves. Positions where
+  # the depth runs out are scored with evaluate, or as draws without
+  # evaluation.
+  def __init__(self, game, depth=2, search="negamax", table=None, tablebase=None, time_budget=None, workers=None, rng=None, timed=False, profile=None, ordering=True, book=None, evaluation=True):
     self.game = game
+    self.depth = MAX_DEPTH if depth is None else min(depth, MAX_DEPTH)
+    self.search = search
+    self.table = table if table is not None else TranspositionTable()
+    self.tablebase = tablebase
+    self.book = book
+    self.time_budget = time_budget
+    self.workers = workers
+    self.rng = rng if rng is not None else random
+    self.timed = timed
+    self.profile = profile
+    self.ordering = ordering
+    self.evaluation = evaluation
+    self.reset_move_ordering()
+
+    self.deadline = None
+    # Nodes searched by the last calculation
+    self.nodes = 0
+    # depth, nodes and elapsed_ms of every completed iteration of the last search
+    self.iterations = []
+    self.stats = SearchStats()
+
+  def reset_move_ordering(self):
+    # killers[ply] -> the last two moves that caused a cutoff at that ply
+    self.killers = [[] for _ in range(MAX_DEPTH + 2)]
+    # history[player][shape * SQUARE_COUNT + square] -> how much that move
+    # caused cutoffs, weighted by the depth left
+    self.history = [[0] * (SHAPE_COUNT * SQUARE_COUNT) for _ in range(2)]
+
+  # Moves sorted with the most promising first: first_move (from the table
+  # or the previous iteration), moves that leave a line only the player to
+  # move can complete because the opponent already placed its last shape,
+  # the killer moves of the ply, then the history table. Immediate wins are
+  # handled before ordering.
+  def order_moves(self, board, moves, ply, first_move=None):
+    history = self.history[board.turn]
+    killers = self.killers[ply]
+
+    def priority(move):
+      shape, square = move
+      return (move == first_move, board.threatens_win(shape, square), move in killers, history[shape * SQUARE_COUNT + square])
+
+    return sorted(moves, key=priority, reverse=True)
+
+  def record_cutoff(self, turn, move, depth, ply):
+    killers = self.killers[ply]
+    if move not in killers:
+      killers.insert(0, move)
+      del killers[2:]
+    shape, square = move
+    self.history[turn][shape * SQUARE_COUNT + square] += depth * depth
 
   def available_vectors(self, game: Game):
     vectors = []
-    for row in range(4):
-      for column in range(4):
-        vector = Vector2(column, row)
-
-        if game.piece_at(vector) is None:
-          vectors.append(vector)
+    occupied = game.board.occupied
+    for square in range(SQUARE_COUNT):
+      if not occupied & (1 << square):
+        vectors.append(SQUARE_VECTORS[square])
     return vectors
 
-  def calculate_move_scores(self, log=False):
-    print(" >> CALCULATING!")
-    # print(f"    {sys.maxsize}")
+  def calculate_move_scores(self):
+    self.player = self.game.active_player
+    self.nodes = 0
+    self.iterations = []
+    self.stats = SearchStats()
+    self.stats.iterations = self.iterations
+    self.reset_move_ordering()
+    table_hits, table_misses = self.table.hits, self.table.misses
+
+    profiler = None
+    if self.profile is not None:
+      profiler = cProfile.Profile()
+      profiler.enable()
+
+    start = time.perf_counter()
+    try:
+      scores = self.score_moves()
+    finally:
+      self.stats.elapsed_ms = (time.perf_counter() - start) * 1000
+      if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(self.profile)
+
+    self.stats.nodes = self.nodes
+    self.stats.table_hits = self.table.hits - table_hits
+    self.stats.table_misses = self.table.misses - table_misses
+    return scores
+
+  def score_moves(self):
     scores = defaultdict(lambda: defaultdict(list))
+    if self.search == "negamax":
+      if self.timed:
+        board = TimedBoard(self.game.board, self.stats)
+      else:
+        board = self.game.board.copy()
+      move_scores = None
+      if self.book is not None:
+        move_scores = self.book_move_scores(board)
+      if move_scores is None and self.tablebase is not None:
+        move_scores = self.tablebase_move_scores(board)
+      if move_scores is None:
+        if self.time_budget is not None:
+          move_scores = self.iterative_deepening(board)
+        elif self.workers is not None:
+          move_scores = self.parallel_root(board, self.depth)
+        else:
+          move_scores = self.negamax_root(board, self.depth)
 
-    for vector_idx, vector in enumerate(self.available_vectors(self.game)):
-        # print(f"    Position {vector_idx} - {vector}")
-        for piece_idx, piece in enumerate(self.game.allowed_pieces_at(vector)[self.game.active_player]):
-          score = self.calculate_score(self.game, piece, vector, log=log)
-          # print(f"       Piece {piece_idx} - {piece.type} -> {score}")
-          scores[score][piece.type].append(vector)
-    print(" >> DONE!")
+      for score, (shape, square) in move_scores:
+        scores[score][SHAPES[shape]].append(SQUARE_VECTORS[square])
+    else:
+      for vector in self.available_vectors(self.game):
+          for piece in self.game.allowed_pieces_at(vector)[self.game.active_player]:
+            score = self.calculate_score(self.game, piece, vector)
+            scores[score][piece.type].append(vector)
 
     return scores
 
-  def calculate_score(self, game: Game, piece: Piece, vector: Vector2, depth=0, is_maximizing=True, log=False):
-    score = 0
-
-    if depth >= 2:
-      return score
-
-    if log:
-      print("")
-      print("")
-      print(f"game orig: {len(self.available_vectors(game))}")
-    game = game.clone()
-    piece = game.active_player.get_piece(piece.type)
-    if log:
-      print(f"game clone: {len(self.available_vectors(game))}")
-    winning_move = game.set_position(piece, vector)
-    if log:
-      print(f"game change: {len(self.available_vectors(game))}")
-      print("")
-      print("")
+  def calculate_score(self, game: Game, piece: Piece, vector: Vector2, depth=0, is_maximizing=False):
+    self.nodes += 1
+    self.stats.nodes_per_ply[depth + 1] += 1
+    move = (piece.type, vector)
+    winning_move = game.apply_move(move)
 
     if winning_move:
-      score = 1
-      if game.active_player != self.game.active_player:
-        score += -1
+      score = WIN_SCORE - (depth + 1)
+      if game.inactive_player != self.player:
+        score = -score
+    elif depth + 1 >= self.depth:
+      score = 0
+      if self.evaluation:
+        score = evaluate(game.board, depth + 2)
+        if game.active_player != self.player:
+          score = -score
     else:
-      best_score = sys.maxsize
-      if is_maximizing:
-        best_score *= -1
+      best_score = None
 
       for vector in self.available_vectors(game):
         pieces = game.allowed_pieces_at(vector)
@@ -72,18 +390,242 @@ class AI:
         for piece in pieces[game.active_player]:
           piece_score = self.calculate_score(game, piece, vector, depth=depth+1, is_maximizing=not is_maximizing)
 
-          if is_maximizing:
+          if best_score is None:
+            best_score = piece_score
+          elif is_maximizing:
             best_score = max(best_score, piece_score)
           else:
             best_score = min(best_score, piece_score)
 
-      score = best_score
+      # No legal replies is a stale mate
+      score = 0 if best_score is None else best_score
+
+    game.undo_move(move)
+
+    return score
+
+  # (score, move) of the best moves in the book, None when the book doesn't
+  # cover the position. The other moves aren't scored.
+  def book_move_scores(self, board):
+    entry = self.book.lookup(board)
+    if entry is None:
+      return None
+
+    self.stats.book_hits += 1
+    score, moves = entry
+    return [(score, move) for move in moves]
+
+  # Exact (score, move) of every legal move, None when the tablebase doesn't
+  # cover the position
+  def tablebase_move_scores(self, board):
+    turn = board.turn
+    move_scores = []
+    for shape, square in board.legal_moves():
+      if board.winning_line(shape, square):
+        score = WIN_SCORE - 1
+      else:
+        board.place(turn, shape, square)
+        value = self.tablebase.lookup(board)
+        board.remove(turn, shape, square)
+        if value is None:
+          return None
+        self.stats.tablebase_hits += 1
+
+        # The value is for the opponent, one ply after this move
+        result, distance = value
+        if result == WIN:
+          score = -(WIN_SCORE - distance - 1)
+        elif result == LOSS:
+          score = WIN_SCORE - distance - 1
+        else:
+          score = 0
+      move_scores.append((score, (shape, square)))
+    return move_scores
+
+  # Searches 1, 2, 3... plies deep and returns the move scores of the deepest
+  # iteration that finished within the time budget. The first iteration
+  # always finishes.
+  def iterative_deepening(self, board):
+    start = time.perf_counter()
+    self.deadline = None
+
+    # No need to look past the last piece
+    remaining = 2 * SHAPE_COUNT - bin(board.occupied).count("1")
+
+    move_scores = None
+    best_move = None
+    for depth in range(1, min(self.depth, remaining) + 1):
+      nodes = self.nodes
+      try:
+        iteration_scores = list(self.negamax_root(board.copy(), depth, best_move))
+      except SearchTimeout:
+        break
+
+      move_scores = iteration_scores
+      best_score, best_move = max(move_scores, key=lambda x: x[0])
+      self.iterations.append({
+        "depth": depth,
+        "nodes": self.nodes - nodes,
+        "elapsed_ms": (time.perf_counter() - start) * 1000
+      })
+
+      # A forced win or loss won't change with more depth
+      if abs(best_score) > WIN_SCORE - MAX_DEPTH - 1:
+        break
+      self.deadline = start + self.time_budget / 1000
+      # negamax only checks the time every 256 nodes, a deeper iteration
+      # started past the deadline could still finish
+      if time.perf_counter() > self.deadline:
+        break
+
+    self.deadline = None
+    return move_scores
+
+  # Exact (score, move) of every legal move, the moves leading to different
+  # positions are scored in parallel
+  def parallel_root(self, board, depth):
+    encoding = board.encode()
+    turn = board.turn
+    executor = process_pool(self.workers)
+
+    moves = board.legal_moves()
+    futures = {}
+    move_keys = []
+    for shape, square in moves:
+      board.place(turn, shape, square)
+      key = canonical_key(board)[0]
+      board.remove(turn, shape, square)
 
-    return score - depth
+      move_keys.append(key)
+      if key not in futures:
+        futures[key] = executor.submit(score_root_move, encoding, (shape, square), depth, self.evaluation)
+
+    results = {key: future.result() for key, future in futures.items()}
+    for score, nodes in results.values():
+      self.nodes += nodes
+    return [(results[key][0], move) for key, move in zip(move_keys, moves)]
+
+  # Yields (score, move) for every legal move of the player to move, starting
+  # with first_move. Scores of moves that can't tie with the best move are
+  # only upper bounds.
+  def negamax_root(self, board, depth, first_move=None):
+    turn = board.turn
+    best_score = -sys.maxsize
+    moves = board.legal_moves()
+    if self.ordering:
+      moves = self.order_moves(board, moves, 1, first_move)
+      # A win first rules out every other move with a single node
+      moves.sort(key=lambda x: not board.winning_line(*x))
+    elif first_move in moves:
+      moves.remove(first_move)
+      moves.insert(0, first_move)
+
+    # Moves leading to symmetric positions share their score
+    canonical_scores = {}
+    for shape, square in moves:
+      if board.winning_line(shape, square):
+        score = WIN_SCORE - 1
+      else:
+        board.place(turn, shape, square)
+        key = canonical_key(board)[0]
+        if key in canonical_scores:
+          score = canonical_scores[key]
+        else:
+          score = -self.negamax(board, depth - 1, 2, -sys.maxsize, 1 - best_score)
+          canonical_scores[key] = score
+        board.remove(turn, shape, square)
+
+      best_score = max(best_score, score)
+      yield score, (shape, square)
+
+  # Score of the position for the player to move
+  def negamax(self, board, depth, ply, alpha, beta):
+    self.nodes += 1
+    self.stats.nodes_per_ply[ply - 1] += 1
+    if self.deadline is not None and self.nodes & 0xFF == 0 and time.perf_counter() > self.deadline:
+      raise SearchTimeout()
+
+    if depth <= 0:
+      if self.evaluation:
+        return evaluate(board, ply)
+      return 0
+
+    moves = board.legal_moves()
+    if not moves:
+      return 0
+
+    turn = board.turn
+    for shape, square in moves:
+      if board.winning_line(shape, square):
+        return WIN_SCORE - ply
+
+    if depth >= CANONICAL_MIN_DEPTH:
+      key, transform = canonical_key(board)
+    else:
+      key, transform = board.key, None
+
+    table_move = None
+    entry = self.table.probe(key)
+    if entry is not None:
+      entry_depth, bound, score, move = entry
+      if entry_depth >= depth:
+        score = score_from_table(score, ply)
+        if bound == EXACT:
+          self.stats.table_cutoffs += 1
+          return score
+        elif bound == LOWER_BOUND:
+          alpha = max(alpha, score)
+        else:
+          beta = min(beta, score)
+        if alpha >= beta:
+          self.stats.table_cutoffs += 1
+          return score
+
+      # Search the best move of the previous visit first
+      table_move = move
+      if transform is not None:
+        table_move = untransform_move(move, transform)
+
+    if self.ordering and depth >= ORDER_MIN_DEPTH:
+      moves = self.order_moves(board, moves, ply, table_move)
+    elif table_move in moves:
+      moves.remove(table_move)
+      moves.insert(0, table_move)
+
+    original_alpha = alpha
+    best_score = -sys.maxsize
+    best_move = None
+    for shape, square in moves:
+      board.place(turn, shape, square)
+      score = -self.negamax(board, depth - 1, ply + 1, -beta, -alpha)
+      board.remove(turn, shape, square)
+
+      if score > best_score:
+        best_score = score
+        best_move = (shape, square)
+        if score > alpha:
+          alpha = score
+          if alpha >= beta:
+            self.stats.cutoffs += 1
+            if self.ordering:
+              self.record_cutoff(turn, best_move, depth, ply)
+            break
+
+    if best_score <= original_alpha:
+      bound = UPPER_BOUND
+    elif best_score >= beta:
+      bound = LOWER_BOUND
+    else:
+      bound = EXACT
+    if transform is not None:
+      best_move = transform_move(best_move, transform)
+    self.table.store(key, depth, bound, score_to_table(best_score, ply), best_move)
 
-    # return score
+    return best_score
 
-  def calculate_best_move(self):
+  # (PieceType, Vector2) to play, with_stats returns the SearchStats of the
+  # calculation next to it
+  def calculate_best_move(self, with_stats=False):
     scores = self.calculate_move_scores()
     max_score = max(scores.keys())
 
@@ -95,7 +637,9 @@ class AI:
     if len(best_pieces) > 0:
       pieces = best_pieces
 
-    random_piece = random.choice(pieces)
-    random_position = random.choice(moves[random_piece])
+    random_piece = self.rng.choice(pieces)
+    random_position = self.rng.choice(moves[random_piece])
 
-    return random_piece, random_position
\ No newline at end of file
+    if with_stats:
+      return (random_piece, random_position), self.stats
+    return random_piece, random_position
@@ -0,0 +1,88 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from ai import AI, worker_context
+from book import Book
+from mcts import MCTS
+from quantik import Game
+from tablebase import Tablebase
+
+# Tablebases opened by this worker process, by path
+_tablebases = {}
+# Opening books of this worker process, by path. The book itself is only
+# read on its first lookup.
+_books = {}
+# MCTS engines of this worker process, by their sorted options. Each is kept
+# so its tree is reused by the next move of the game.
+_mcts = {}
+
+def _tablebase(path):
+  if path is None or not os.path.exists(path):
+    return None
+  if path not in _tablebases:
+    _tablebases[path] = Tablebase(path)
+  return _tablebases[path]
+
+def _book(path):
+  if path is None or not os.path.exists(path):
+    return None
+  if path not in _books:
+    _books[path] = Book(path)
+  return _books[path]
+
+# The position is passed as Game.to_bytes()
+def calculate_best_move(snapshot, ai_options, tablebase_path=None, engine="ai", book_path=None):
+  game = Game.from_bytes(snapshot)
+  if engine == "mcts":
+    options = tuple(sorted(ai_options.items()))
+    if options not in _mcts:
+      _mcts[options] = MCTS(game, **ai_options)
+    mcts = _mcts[options]
+    mcts.game = game
+    return mcts.calculate_best_move()
+
+  ai = AI(game, tablebase=_tablebase(tablebase_path), book=_book(book_path), **ai_options)
+  return ai.calculate_best_move()
+
+class AIService:
+  # Calculates AI moves in a worker process so the caller's loop keeps
+  # running. engine is "ai" or "mcts", ai_options are passed on to ai.AI or
+  # mcts.MCTS.
+  def __init__(self, workers=1, tablebase_path=None, book_path=None, engine="ai", **ai_options):
+    self.workers = workers
+    self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=worker_context())
+    self.tablebase_path = tablebase_path
+    self.book_path = book_path
+    self.engine = engine
+    self.ai_options = ai_options
+    self.future = None
+
+  # Returns a future resolving to the (PieceType, Vector2) for the active
+  # player, a pending move is cancelled first. A worker that died broke the
+  # executor, it's replaced by a new one.
+  def submit(self, game):
+    self.cancel()
+    args = (calculate_best_move, game.to_bytes(), self.ai_options, self.tablebase_path, self.engine, self.book_path)
+    try:
+      self.future = self.executor.submit(*args)
+    except BrokenProcessPool:
+      self.executor.shutdown(wait=False, cancel_futures=True)
+      self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=worker_context())
+      self.future = self.executor.submit(*args)
+    return self.future
+
+  # The move calculated in this process, without the tablebase and book,
+  # for when the worker failed
+  def fallback_move(self, game):
+    return calculate_best_move(game.to_bytes(), self.ai_options, engine=self.engine)
+
+  # A move that's already being calculated can't be interrupted, its
+  # result is dropped instead
+  def cancel(self):
+    if self.future is not None:
+      self.future.cancel()
+      self.future = None
+
+  def shutdown(self):
+    self.cancel()
+    self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,78 @@
+from collections import namedtuple
+import numpy as np
+from board import BOARD_SIZE, LINE_MASKS, LINE_SQUARES, SHAPE_COUNT, SQUARE_COUNT, SQUARE_LINES, square_position
+from quantik import Game, PieceType, SHAPES
+
+# Rule checks for many positions at once. A position is a row of 16 square
+# codes, the nibbles of Board.encode(): 0 for empty, else 1 + shape * 2 +
+# player. The player to move isn't stored, white moves when both players
+# placed as many pieces.
+
+# LINE_INDEX[line] -> the 4 squares of every row, column and quadrant
+LINE_INDEX = np.array([LINE_SQUARES[mask] for mask in LINE_MASKS], dtype=np.intp)
+# SQUARE_LINE_INDEX[square] -> the row, column and quadrant of the square as
+# indices into LINE_INDEX
+SQUARE_LINE_INDEX = np.array(
+  [[LINE_MASKS.index(mask) for mask in SQUARE_LINES[square]] for square in range(SQUARE_COUNT)],
+  dtype=np.intp
+)
+
+# legal and wins are (N, 16, 4) masks of (square, shape) for the player to
+# move, terminal is set for positions that are won or stale mate
+Evaluation = namedtuple("Evaluation", ["legal", "wins", "won", "stale_mate", "terminal", "turn"])
+
+def encode_game(game):
+  value = game.board.encode()
+  return np.array(
+    [(value >> (4 * (SQUARE_COUNT - 1 - square))) & 0xF for square in range(SQUARE_COUNT)],
+    dtype=np.uint8
+  )
+
+def encode_games(games):
+  squares = np.zeros((len(games), SQUARE_COUNT), dtype=np.uint8)
+  for index, game in enumerate(games):
+    squares[index] = encode_game(game)
+  return squares
+
+def decode_game(row):
+  pieces = [{piece_type.value: None for piece_type in PieceType} for player in range(2)]
+  for square, code in enumerate(row):
+    if code:
+      pieces[(int(code) - 1) & 1][SHAPES[(int(code) - 1) >> 1].value] = square_position(square)
+
+  placed = np.count_nonzero(row)
+  return Game(data={
+    "player1": {"color": "white", "pieces": pieces[0]},
+    "player2": {"color": "black", "pieces": pieces[1]},
+    "active_player": "white" if placed % 2 == 0 else "black"
+  })
+
+def evaluate(squares):
+  squares = np.asarray(squares, dtype=np.uint8).reshape(-1, SQUARE_COUNT)
+  codes = squares.astype(np.int16) - 1
+  occupied = squares > 0
+
+  # (N, 16, 4) shape on every square, (N, 2, 4) shapes placed per player
+  shape_at = occupied[:, :, None] & (codes[:, :, None] >> 1 == np.arange(SHAPE_COUNT))
+  player_at = codes & 1
+  placed = np.stack([(shape_at & (player_at == player)[:, :, None]).any(axis=1) for player in range(2)], axis=1)
+  turn = np.count_nonzero(occupied, axis=1) % 2
+
+  # (N, 12, 4) shapes in every line and (N, 12) pieces in every line
+  line_shapes = shape_at[:, LINE_INDEX, :].any(axis=2)
+  line_counts = occupied[:, LINE_INDEX].sum(axis=2)
+  line_distinct = line_shapes.sum(axis=2)
+  won = ((line_counts == BOARD_SIZE) & (line_distinct == SHAPE_COUNT)).any(axis=1)
+
+  # A shape can't go next to the same shape of either player
+  forbidden = line_shapes[:, SQUARE_LINE_INDEX, :].any(axis=2)
+  available = ~placed[np.arange(len(squares)), turn]
+  legal = ~occupied[:, :, None] & ~forbidden & available[:, None, :] & ~won[:, None, None]
+
+  # A line with 3 different shapes is completed by the missing one
+  completable = (line_counts == BOARD_SIZE - 1) & (line_distinct == SHAPE_COUNT - 1)
+  completes = (completable[:, :, None] & ~line_shapes)[:, SQUARE_LINE_INDEX, :].any(axis=2)
+  wins = legal & completes
+
+  stale_mate = ~won & ~legal.any(axis=(1, 2))
+  return Evaluation(legal, wins, won, stale_mate, won | stale_mate, turn)
@@ -0,0 +1,247 @@
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from ai import AI
+from quantik import Game, PieceType, SQUARE_VECTORS
+from transposition import TranspositionTable
+
+# Positions as {piece type: (x, y)} for white and black, white moves when
+# both placed as many pieces
+CORPORA = {
+  "opening": [
+    ({"Cylinder": (3, 3)}, {"Plus": (0, 1)}),
+    ({"Cylinder": (3, 2)}, {"Triange": (2, 0)}),
+    ({"Cylinder": (0, 3)}, {"Triange": (0, 0)}),
+    ({"Square": (3, 2)}, {"Cylinder": (0, 2)})
+  ],
+  "middlegame": [
+    ({"Plus": (3, 2), "Square": (0, 2)}, {"Triange": (1, 1), "Plus": (0, 3)}),
+    ({"Cylinder": (0, 0), "Plus": (0, 1)}, {"Cylinder": (2, 2), "Triange": (1, 3)}),
+    ({"Plus": (1, 2), "Square": (3, 2)}, {"Plus": (2, 0), "Square": (1, 1)}),
+    ({"Triange": (1, 1), "Square": (1, 0)}, {"Triange": (2, 0), "Plus": (3, 2)})
+  ],
+  "endgame": [
+    ({"Triange": (1, 0), "Plus": (1, 2), "Square": (2, 2)}, {"Cylinder": (1, 3), "Plus": (2, 3), "Square": (0, 0)}),
+    ({"Triange": (2, 0), "Plus": (3, 2), "Square": (1, 0)}, {"Cylinder": (2, 1), "Triange": (1, 2), "Square": (3, 3)}),
+    ({"Cylinder": (2, 3), "Triange": (0, 3), "Square": (3, 3)}, {"Cylinder": (3, 0), "Plus": (0, 2), "Square": (1, 0)}),
+    ({"Cylinder": (1, 1), "Triange": (1, 0), "Square": (3, 0)}, {"Cylinder": (3, 2), "Triange": (3, 3), "Square": (1, 3)})
+  ]
+}
+
+def position_data(white, black):
+  def pieces(placed):
+    return {piece_type.value: placed.get(piece_type.value) for piece_type in PieceType}
+
+  return {
+    "player1": {"color": "white", "pieces": pieces(white)},
+    "player2": {"color": "black", "pieces": pieces(black)},
+    "active_player": "white" if len(white) == len(black) else "black"
+  }
+
+def corpus_games(corpus=None):
+  names = [corpus] if corpus else list(CORPORA)
+  return [Game(data=position_data(white, black)) for name in names for white, black in CORPORA[name]]
+
+def legal_moves(game):
+  return list(game.legal_moves())
+
+# Every benchmark runs over its games and returns how many operations it did
+
+def bench_piece_at(games):
+  for game in games:
+    for vector in SQUARE_VECTORS:
+      game.piece_at(vector)
+  return len(games) * len(SQUARE_VECTORS)
+
+def bench_allowed_pieces_at(games):
+  for game in games:
+    for vector in SQUARE_VECTORS:
+      game.allowed_pieces_at(vector)
+  return len(games) * len(SQUARE_VECTORS)
+
+def bench_is_winning_move(games):
+  operations = 0
+  for game in games:
+    for piece_type, vector in legal_moves(game):
+      game.is_winning_move(game.active_player.get_piece(piece_type), vector)
+      operations += 1
+  return operations
+
+def bench_legal_moves(games):
+  for game in games:
+    game.board.legal_moves()
+  return len(games)
+
+def bench_has_legal_move(games):
+  for game in games:
+    game.board.has_legal_move()
+  return len(games)
+
+def bench_apply_undo(games):
+  operations = 0
+  for game in games:
+    for move in legal_moves(game):
+      game.apply_move(move)
+      game.undo_move(move)
+      operations += 1
+  return operations
+
+def bench_clone(games):
+  for game in games:
+    game.clone()
+  return len(games)
+
+def bench_search(depth, search="negamax", ordering=True):
+  def bench(games):
+    nodes = 0
+    for game in games:
+      ai = AI(game, depth=depth, search=search, table=TranspositionTable(), ordering=ordering)
+      ai.calculate_move_scores()
+      nodes += ai.nodes
+    return nodes
+  return bench
+
+# name -> (benchmark, games, times to run it per measurement, unit)
+def benchmarks():
+  games = corpus_games()
+  suite = {
+    "piece_at": (bench_piece_at, games, 200, "ops/s"),
+    "allowed_pieces_at": (bench_allowed_pieces_at, games, 50, "ops/s"),
+    "is_winning_move": (bench_is_winning_move, games, 20, "ops/s"),
+    "legal_moves": (bench_legal_moves, games, 500, "ops/s"),
+    "has_legal_move": (bench_has_legal_move, games, 500, "ops/s"),
+    "apply_undo": (bench_apply_undo, games, 20, "ops/s"),
+    "clone": (bench_clone, games, 200, "ops/s")
+  }
+  for corpus in CORPORA:
+    corpus_game_list = corpus_games(corpus)
+    suite[f"minimax_depth_2/{corpus}"] = (bench_search(2, "minimax"), corpus_game_list, 1, "nodes/s")
+    for depth in (2, 4, None):
+      name = f"search_depth_{depth or 'full'}/{corpus}"
+      suite[name] = (bench_search(depth), corpus_game_list, 1, "nodes/s")
+    # The same searches without move ordering show what it saves in nodes
+    for depth in (4, None):
+      name = f"search_depth_{depth or 'full'}_unordered/{corpus}"
+      suite[name] = (bench_search(depth, ordering=False), corpus_game_list, 1, "nodes/s")
+  return suite
+
+def run(repeat=5, name_filter=None):
+  results = {}
+  for name, (benchmark, games, iterations, unit) in benchmarks().items():
+    if name_filter and name_filter not in name:
+      continue
+
+    rates = []
+    seconds = []
+    for _ in range(repeat):
+      start = time.perf_counter()
+      operations = 0
+      for _ in range(iterations):
+        operations += benchmark(games)
+      seconds.append(time.perf_counter() - start)
+      rates.append(operations / seconds[-1])
+
+    results[name] = {
+      "unit": unit,
+      "mean": statistics.mean(rates),
+      "stdev": statistics.stdev(rates) if len(rates) > 1 else 0.0,
+      "runs": rates,
+      "seconds": statistics.mean(seconds),
+      # For searches the nodes they took, which is the same on every run
+      "operations": operations
+    }
+    print(f"{name:40} {results[name]['mean']:14,.0f} {unit:12} ±{results[name]['stdev'] / results[name]['mean']:.1%} {operations:>10,} ops")
+  return results
+
+# Unfinished positions after 1 to 6 random moves
+def random_positions(count, seed=0):
+  rng = random.Random(seed)
+  games = []
+  while len(games) < count:
+    game = Game()
+    for _ in range(rng.randrange(1, 7)):
+      game.apply_move(rng.choice(list(game.legal_moves())))
+      if game.winner is not None or game.in_stale_mate:
+        break
+    if game.winner is None and not game.in_stale_mate:
+      games.append(game)
+  return games
+
+def best_moves(scores):
+  best_score = max(scores)
+  return {(piece_type, vector) for piece_type, vectors in scores[best_score].items() for vector in vectors}
+
+# How often depth limited searches, with and without evaluation, pick a move
+# that's among the best moves of a full search. A search picks randomly
+# between its best moves, so a position counts for the share of them that's
+# also best in the full search.
+def accuracy(depths, count, seed=0):
+  games = random_positions(count, seed)
+  solutions = [best_moves(AI(game, depth=None).calculate_move_scores()) for game in games]
+
+  results = {}
+  for depth in depths:
+    for evaluation in (False, True):
+      correct = 0.0
+      start = time.perf_counter()
+      for game, solution in zip(games, solutions):
+        moves = best_moves(AI(game, depth=depth, evaluation=evaluation).calculate_move_scores())
+        correct += len(moves & solution) / len(moves)
+      elapsed = time.perf_counter() - start
+
+      name = f"depth_{depth}{'' if evaluation else '_no_evaluation'}"
+      results[name] = {"accuracy": correct / len(games), "ms_per_position": elapsed * 1000 / len(games)}
+      print(f"{name:40} {results[name]['accuracy']:8.1%} best moves {results[name]['ms_per_position']:10.2f} ms/position")
+  return results
+
+# Names of the benchmarks that take longer than the baseline by more than the
+# threshold. Searches are compared on time rather than nodes/s, so visiting
+# fewer nodes doesn't count against them.
+def regressions(results, baseline, threshold):
+  slower = []
+  for name, result in results.items():
+    if name not in baseline:
+      continue
+    change = result["seconds"] / baseline[name]["seconds"] - 1
+    operations_change = result["operations"] / baseline[name]["operations"] - 1
+    flag = "REGRESSION" if change > threshold else ""
+    print(f"{name:40} {change:+8.1%} time {operations_change:+8.1%} ops {flag}")
+    if flag:
+      slower.append(name)
+  return slower
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the Quantik rules and AI search")
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+  parser.add_argument("--save", help="write the results to this JSON baseline file")
+  parser.add_argument("--compare", help="compare the results with this JSON baseline file")
+  parser.add_argument("--threshold", type=float, default=0.1, help="slowdown that counts as a regression, 0.1 is 10%%")
+  parser.add_argument("--accuracy", type=int, metavar="POSITIONS", help="instead compare depth limited searches with full searches on this many random positions")
+  args = parser.parse_args()
+
+  if args.accuracy:
+    accuracy(range(1, 5), args.accuracy)
+    return
+
+  results = run(args.repeat, args.filter)
+
+  if args.save:
+    with open(args.save, "w") as outfile:
+      json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results}, outfile, indent=2)
+
+  if args.compare:
+    with open(args.compare) as infile:
+      baseline = json.load(infile)["results"]
+    print("")
+    slower = regressions(results, baseline, args.threshold)
+    if slower:
+      print(f"{len(slower)} benchmarks regressed by more than {args.threshold:.0%}")
+      return 1
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,267 @@
+import random
+
+BOARD_SIZE = 4
+SQUARE_COUNT = BOARD_SIZE * BOARD_SIZE
+SHAPE_COUNT = 4
+FULL_MASK = (1 << SQUARE_COUNT) - 1
+
+def square_index(x, y):
+  return y * BOARD_SIZE + x
+
+def square_position(square):
+  return square % BOARD_SIZE, square // BOARD_SIZE
+
+def on_board(x, y):
+  return 0 <= x < BOARD_SIZE and 0 <= y < BOARD_SIZE
+
+# A move as one shape * SQUARE_COUNT + square number, which fits a byte
+def pack_move(shape, square):
+  return shape * SQUARE_COUNT + square
+
+def unpack_move(move):
+  return divmod(move, SQUARE_COUNT)
+
+def quadrant_index(x, y):
+  return (y // 2) * 2 + x // 2
+
+def squares_in(mask):
+  return [square for square in range(SQUARE_COUNT) if mask & (1 << square)]
+
+def mask_of(squares):
+  mask = 0
+  for square in squares:
+    mask |= 1 << square
+  return mask
+
+# SQUARE_PEERS[square] -> (row, column, quadrant) squares sharing a line with
+# the square, without the square itself. All rule checks are derived from it.
+SQUARE_PEERS = tuple(
+  (
+    tuple(square_index(column, y) for column in range(BOARD_SIZE) if column != x),
+    tuple(square_index(x, row) for row in range(BOARD_SIZE) if row != y),
+    tuple(
+      square_index(column, row)
+      for row in range(BOARD_SIZE) for column in range(BOARD_SIZE)
+      if quadrant_index(column, row) == quadrant_index(x, y) and (column, row) != (x, y)
+    )
+  )
+  for y in range(BOARD_SIZE) for x in range(BOARD_SIZE)
+)
+
+# (row, column, quadrant) mask for every square
+SQUARE_LINES = tuple(
+  tuple(mask_of(peers) | (1 << square) for peers in lines)
+  for square, lines in enumerate(SQUARE_PEERS)
+)
+# Every other square sharing a row, column or quadrant with the square
+PEER_MASKS = tuple(
+  mask_of(row + column + quadrant)
+  for row, column, quadrant in SQUARE_PEERS
+)
+
+ROW_MASKS = tuple(SQUARE_LINES[square_index(0, y)][0] for y in range(BOARD_SIZE))
+COLUMN_MASKS = tuple(SQUARE_LINES[square_index(x, 0)][1] for x in range(BOARD_SIZE))
+QUADRANT_MASKS = tuple(SQUARE_LINES[square_index(x, y)][2] for y in (0, 2) for x in (0, 2))
+LINE_MASKS = ROW_MASKS + COLUMN_MASKS + QUADRANT_MASKS
+# Squares of every row, column and quadrant by mask
+LINE_SQUARES = {mask: tuple(squares_in(mask)) for mask in LINE_MASKS}
+
+# Zobrist keys for every (player, shape, square) and for black to move,
+# seeded so keys are stable between runs
+_zobrist_random = random.Random(0x5157)
+ZOBRIST_PIECES = tuple(
+  tuple(tuple(_zobrist_random.getrandbits(64) for square in range(SQUARE_COUNT)) for shape in range(SHAPE_COUNT))
+  for player in range(2)
+)
+ZOBRIST_TURN = _zobrist_random.getrandbits(64)
+
+class Board:
+  __slots__ = ("pieces", "shapes", "forbidden", "occupied", "turn", "key")
+
+  def __init__(self):
+    # pieces[player][shape] -> occupancy mask of that player's pieces of that shape
+    self.pieces = [[0] * SHAPE_COUNT, [0] * SHAPE_COUNT]
+    # shapes[shape] -> occupancy mask of that shape for both players
+    self.shapes = [0] * SHAPE_COUNT
+    # forbidden[shape] -> squares that shape can't be placed on, the peers of
+    # the squares holding it. Kept up to date by place and remove.
+    self.forbidden = [0] * SHAPE_COUNT
+    self.occupied = 0
+    self.turn = 0
+    self.key = 0
+
+  def copy(self):
+    board = Board.__new__(Board)
+    board.pieces = [self.pieces[0][:], self.pieces[1][:]]
+    board.shapes = self.shapes[:]
+    board.forbidden = self.forbidden[:]
+    board.occupied = self.occupied
+    board.turn = self.turn
+    board.key = self.key
+    return board
+
+  def piece_at(self, square):
+    bit = 1 << square
+    if not self.occupied & bit:
+      return None
+
+    for player in range(2):
+      for shape, mask in enumerate(self.pieces[player]):
+        if mask & bit:
+          return player, shape
+
+  def allowed_shapes(self, square):
+    # Bitmask of shapes that may be placed on the square, by either player
+    bit = 1 << square
+    if self.occupied & bit:
+      return 0
+
+    forbidden = self.forbidden
+    allowed = 0
+    for shape in range(SHAPE_COUNT):
+      if not forbidden[shape] & bit:
+        allowed |= 1 << shape
+    return allowed
+
+  def is_legal(self, player, shape, square):
+    if self.pieces[player][shape]:
+      return False
+    return not (self.occupied | self.forbidden[shape]) & (1 << square)
+
+  def winning_line(self, shape, square):
+    # Mask of the row, column or quadrant completed by placing shape on square, 0 if none
+    bit = 1 << square
+    occupied = self.occupied | bit
+    shapes = self.shapes
+    for line in SQUARE_LINES[square]:
+      if occupied & line != line:
+        continue
+
+      if all((shapes[other] | (bit if other == shape else 0)) & line for other in range(SHAPE_COUNT)):
+        return line
+    return 0
+
+  # Shape that completes the line left with three different shapes and a single
+  # empty square by placing shape on square, with that square, or None
+  def _last_shape(self, line, shape, square):
+    empty = line & ~(self.occupied | (1 << square))
+    if not empty or empty & (empty - 1):
+      return None
+
+    missing = [other for other in range(SHAPE_COUNT) if other != shape and not self.shapes[other] & line]
+    if len(missing) != 1:
+      return None
+
+    other_square = empty.bit_length() - 1
+    if self.forbidden[missing[0]] & empty:
+      return None
+    return missing[0], other_square
+
+  def gives_win(self, shape, square):
+    # Whether placing shape on square, for the player to move, leaves a line
+    # that the opponent completes on the next move
+    opponent = self.pieces[self.turn ^ 1]
+    for line in SQUARE_LINES[square]:
+      last = self._last_shape(line, shape, square)
+      if last is not None and not opponent[last[0]]:
+        return True
+    return False
+
+  def threatens_win(self, shape, square):
+    # Whether placing shape on square, for the player to move, leaves a line
+    # that only the player to move can complete, the opponent already placed
+    # its last shape
+    pieces = self.pieces[self.turn]
+    opponent = self.pieces[self.turn ^ 1]
+    for line in SQUARE_LINES[square]:
+      last = self._last_shape(line, shape, square)
+      if last is not None and opponent[last[0]] and not pieces[last[0]]:
+        return True
+    return False
+
+  def place(self, player, shape, square):
+    bit = 1 << square
+    self.pieces[player][shape] |= bit
+    self.shapes[shape] |= bit
+    self.forbidden[shape] |= PEER_MASKS[square]
+    self.occupied |= bit
+    self.turn ^= 1
+    self.key ^= ZOBRIST_PIECES[player][shape][square] ^ ZOBRIST_TURN
+
+  def remove(self, player, shape, square):
+    bit = ~(1 << square)
+    self.pieces[player][shape] &= bit
+    self.shapes[shape] &= bit
+    # Peers overlap between squares, so the mask is rebuilt from the other
+    # piece of the shape
+    forbidden = 0
+    remaining = self.shapes[shape]
+    while remaining:
+      other = remaining & -remaining
+      forbidden |= PEER_MASKS[other.bit_length() - 1]
+      remaining ^= other
+    self.forbidden[shape] = forbidden
+    self.occupied &= bit
+    self.turn ^= 1
+    self.key ^= ZOBRIST_PIECES[player][shape][square] ^ ZOBRIST_TURN
+
+  def set_turn(self, turn):
+    if turn != self.turn:
+      self.turn = turn
+      self.key ^= ZOBRIST_TURN
+
+  # Squares the shape can be placed on, by a player who still has it
+  def legal_squares(self, shape):
+    return FULL_MASK & ~(self.occupied | self.forbidden[shape])
+
+  def has_legal_move(self):
+    pieces = self.pieces[self.turn]
+    for shape in range(SHAPE_COUNT):
+      if not pieces[shape] and self.legal_squares(shape):
+        return True
+    return False
+
+  # (shape, square) of every legal move for the player to move
+  def legal_moves(self):
+    pieces = self.pieces[self.turn]
+    blocked = self.occupied
+    shapes = []
+    for shape in range(SHAPE_COUNT):
+      if not pieces[shape]:
+        shapes.append((shape, self.forbidden[shape] | blocked))
+    if not shapes:
+      return []
+
+    moves = []
+    for square in range(SQUARE_COUNT):
+      bit = 1 << square
+      if blocked & bit:
+        continue
+
+      for shape, unavailable in shapes:
+        if not unavailable & bit:
+          moves.append((shape, square))
+    return moves
+
+  # Position as an int: one nibble per square with square 0 in the most
+  # significant one (0 for empty, else 1 + shape * 2 + player), the player to
+  # move is stored above the squares
+  def encode(self):
+    value = self.turn << (4 * SQUARE_COUNT)
+    for player in range(2):
+      for shape, mask in enumerate(self.pieces[player]):
+        while mask:
+          bit = mask & -mask
+          value |= (1 + shape * 2 + player) << (4 * (SQUARE_COUNT - bit.bit_length()))
+          mask ^= bit
+    return value
+
+  @classmethod
+  def decode(cls, value):
+    board = cls()
+    for square in range(SQUARE_COUNT):
+      code = (value >> (4 * (SQUARE_COUNT - 1 - square))) & 0xF
+      if code:
+        board.place((code - 1) & 1, (code - 1) >> 1, square)
+    board.set_turn(value >> (4 * SQUARE_COUNT))
+    return board
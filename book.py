@@ -0,0 +1,129 @@
+import argparse
+import hashlib
+import os
+import struct
+import sys
+import time
+from ai import AI
+from board import Board, pack_move, unpack_move
+from symmetry import canonicalize, transform_move, untransform_move
+from transposition import TranspositionTable
+
+DEFAULT_PATH = "quantik.book"
+DEFAULT_PLIES = 6
+
+MAGIC = b"QKBK"
+VERSION = 1
+# magic, version, plies covered, number of positions
+HEADER = struct.Struct("<4sHHI")
+# squares of the canonical encoding, player to move, score, number of best
+# moves, followed by the moves as one board.pack_move byte each
+RECORD = struct.Struct("<QBbB")
+
+SQUARES_MASK = (1 << 64) - 1
+
+# Best moves of every position in which one of the first plies moves is made,
+# keyed by canonical encoding. Values are (score, moves) with the moves in
+# the canonical position, depth is passed on to ai.AI.
+def build(plies=DEFAULT_PLIES, depth=None):
+  ai = AI(None, depth=depth, table=TranspositionTable(1 << 20))
+  entries = {}
+
+  def add_position(board, ply):
+    encoding, transform = canonicalize(board)
+    if encoding in entries:
+      return
+
+    moves = board.legal_moves()
+    if not moves:
+      return
+
+    move_scores = list(ai.negamax_root(board.copy(), ai.depth))
+    best_score = max(score for score, move in move_scores)
+    best_moves = sorted(transform_move(move, transform) for score, move in move_scores if score == best_score)
+    entries[encoding] = (best_score, best_moves)
+
+    if ply + 1 >= plies:
+      return
+
+    turn = board.turn
+    for shape, square in moves:
+      if board.winning_line(shape, square):
+        continue
+      board.place(turn, shape, square)
+      add_position(board, ply + 1)
+      board.remove(turn, shape, square)
+
+  add_position(Board(), 0)
+  return entries
+
+def write(entries, path, plies):
+  with open(path, "wb") as outfile:
+    outfile.write(HEADER.pack(MAGIC, VERSION, plies, len(entries)))
+    for encoding in sorted(entries):
+      score, moves = entries[encoding]
+      outfile.write(RECORD.pack(encoding & SQUARES_MASK, encoding >> 64, score, len(moves)))
+      outfile.write(bytes(pack_move(shape, square) for shape, square in moves))
+
+class Book:
+  # The file is read on the first lookup, so opening a book costs nothing
+  # until the AI needs it
+  def __init__(self, path=DEFAULT_PATH):
+    self.path = path
+    self.entries = None
+    self.plies = None
+
+  def load(self):
+    with open(self.path, "rb") as infile:
+      data = infile.read()
+
+    magic, version, self.plies, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+      raise Exception(f"{self.path} is not a version {VERSION} Quantik opening book")
+
+    entries = {}
+    offset = HEADER.size
+    for _ in range(count):
+      squares, turn, score, move_count = RECORD.unpack_from(data, offset)
+      offset += RECORD.size
+      moves = [unpack_move(move) for move in data[offset:offset + move_count]]
+      offset += move_count
+      entries[turn << 64 | squares] = (score, moves)
+    self.entries = entries
+
+  def __len__(self):
+    if self.entries is None:
+      self.load()
+    return len(self.entries)
+
+  # (score, best moves) of the board for the player to move, None when the
+  # book doesn't cover the position
+  def lookup(self, board):
+    if self.entries is None:
+      self.load()
+
+    encoding, transform = canonicalize(board)
+    entry = self.entries.get(encoding)
+    if entry is None:
+      return None
+    score, moves = entry
+    return score, [untransform_move(move, transform) for move in moves]
+
+def main():
+  parser = argparse.ArgumentParser(description="Write the best moves of the first moves of the game to an opening book")
+  parser.add_argument("--plies", type=int, default=DEFAULT_PLIES, help="moves from the start of the game to cover")
+  parser.add_argument("--depth", type=int, default=0, help="search depth per position, 0 searches until the end of the game")
+  parser.add_argument("--output", default=DEFAULT_PATH)
+  args = parser.parse_args()
+
+  start = time.time()
+  entries = build(args.plies, args.depth or None)
+  write(entries, args.output, args.plies)
+
+  with open(args.output, "rb") as infile:
+    checksum = hashlib.sha256(infile.read()).hexdigest()
+  print(f"Wrote {len(entries)} positions in {time.time() - start:.1f}s, {os.path.getsize(args.output)} bytes")
+  print(f"{args.output} sha256 {checksum}")
+
+if __name__ == "__main__":
+  sys.exit(main())
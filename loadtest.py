@@ -0,0 +1,145 @@
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import sys
+import time
+from quantik import Game
+from server import AIPool, DEFAULT_PORT, Metrics, Server, encode_move, percentile, start
+
+class Client:
+  # One connection to server.py, requests are answered in order
+  def __init__(self, reader, writer):
+    self.reader = reader
+    self.writer = writer
+    self.request_ids = itertools.count(1)
+
+  @classmethod
+  async def connect(cls, host="127.0.0.1", port=DEFAULT_PORT, unix_path=None):
+    if unix_path is not None:
+      reader, writer = await asyncio.open_unix_connection(unix_path)
+    else:
+      reader, writer = await asyncio.open_connection(host, port)
+    return cls(reader, writer)
+
+  async def request(self, op, **fields):
+    self.writer.write(json.dumps({"id": next(self.request_ids), "op": op, **fields}).encode() + b"\n")
+    await self.writer.drain()
+    line = await self.reader.readline()
+    if not line:
+      raise ConnectionError("the server closed the connection")
+    return json.loads(line)
+
+  async def close(self):
+    self.writer.close()
+    await self.writer.wait_closed()
+
+class LoadStats:
+  def __init__(self):
+    self.sessions = 0
+    self.moves = 0
+    self.errors = 0
+    self.timeouts = 0
+    # Milliseconds from sending a move to the answer with the AI move
+    self.latencies_ms = []
+
+# Plays a random legal move for white every turn against the AI as black
+async def play_session(connect, rng, depth, timeout, stats):
+  client = await connect()
+  try:
+    response = await client.request("new", ai="black", depth=depth, timeout=timeout)
+    if not response["ok"]:
+      stats.errors += 1
+      return
+
+    session = response["session"]
+    state = response["state"]
+    while state["winner"] is None and not state["stale_mate"]:
+      game = Game.from_bytes(bytes.fromhex(state["position"]))
+      move = rng.choice(list(game.legal_moves()))
+
+      start = time.perf_counter()
+      response = await client.request("move", session=session, move=encode_move(move))
+      if not response["ok"]:
+        if response["error"] == "timeout":
+          stats.timeouts += 1
+        else:
+          stats.errors += 1
+        return
+      stats.latencies_ms.append((time.perf_counter() - start) * 1000)
+      stats.moves += 1
+      state = response["state"]
+
+    await client.request("close", session=session)
+    stats.sessions += 1
+  finally:
+    await client.close()
+
+async def run(args):
+  pool = None
+  server = None
+  listener = None
+  host, port, unix_path = args.host, args.port, args.unix
+  if args.local:
+    # Server in this process on a free port, its AI runs in worker processes
+    metrics = Metrics()
+    pool = AIPool(metrics, args.workers, args.queue)
+    server = Server(pool, metrics, max_depth=args.depth, timeout=args.timeout)
+    listener = await start(server, host, 0, unix_path)
+    if unix_path is None:
+      port = listener.sockets[0].getsockname()[1]
+
+  def connect():
+    return Client.connect(host, port, unix_path)
+
+  stats = LoadStats()
+  session_indices = iter(range(args.sessions))
+
+  async def play_sessions():
+    for index in session_indices:
+      await play_session(connect, random.Random(f"{args.seed}:{index}"), args.depth, args.timeout, stats)
+
+  try:
+    start_time = time.perf_counter()
+    await asyncio.gather(*(play_sessions() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start_time
+
+    client = await connect()
+    server_metrics = (await client.request("metrics"))["metrics"]
+    await client.close()
+  finally:
+    if listener is not None:
+      # Lets the server see every client leave before the loop stops
+      while server.connections:
+        await asyncio.sleep(0.01)
+      listener.close()
+      await listener.wait_closed()
+    if pool is not None:
+      pool.shutdown()
+
+  latencies = stats.latencies_ms
+  print(f"{stats.sessions} sessions in {elapsed:.2f}s, {stats.sessions / elapsed:.1f} sessions/s, {stats.moves / elapsed:.1f} moves/s")
+  print(f"  move latency p50 {percentile(latencies, 0.5):.1f}ms, p99 {percentile(latencies, 0.99):.1f}ms, max {max(latencies, default=0.0):.1f}ms")
+  print(f"  {stats.timeouts} timeouts, {stats.errors} errors")
+  print(f"  server: peak queue depth {server_metrics['peak_queue_depth']}, AI latency p99 {server_metrics['latency_p99_ms']:.1f}ms, {server_metrics['timeouts']} timeouts")
+
+def main():
+  parser = argparse.ArgumentParser(description="Play many sessions against server.py at once and report the throughput and move latency")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+  parser.add_argument("--unix", help="connect to this Unix socket instead of TCP")
+  parser.add_argument("--local", action="store_true", help="start a server in this process instead of connecting to a running one")
+  parser.add_argument("--workers", type=int, help="AI processes of the --local server")
+  parser.add_argument("--queue", type=int, help="AI moves submitted at a time by the --local server")
+  parser.add_argument("--sessions", type=int, default=200)
+  parser.add_argument("--concurrency", type=int, default=20, help="sessions played at the same time")
+  parser.add_argument("--depth", type=int, default=2)
+  parser.add_argument("--timeout", type=float, default=10.0, help="seconds per AI move")
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+
+  asyncio.run(run(args))
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -1,9 +1,13 @@
 import math
 import pygame
-from ai import AI
+from ai_service import AIService
 from collections import defaultdict
 from utils import Vector2
-from quantik import Game, PieceType
+from board import square_index
+from quantik import Game, PieceType, SQUARE_VECTORS
+from book import DEFAULT_PATH as BOOK_PATH
+from records import RecordWriter
+from tablebase import DEFAULT_PATH as TABLEBASE_PATH
 
 # pygame setup
 pygame.init()
@@ -23,12 +27,35 @@ if load_from_dump:
 else:
   game = Game()
 selected_piece = None
-ai = AI(game)
+ai_depth = None
+ai_time_budget = 250 # ms
+# The AI uses the tablebase and opening book when they've been generated with
+# `python3 tablebase.py` and `python3 book.py`
+ai_service = AIService(tablebase_path=TABLEBASE_PATH, book_path=BOOK_PATH, depth=ai_depth, time_budget=ai_time_budget)
+ai_move = None
 ai_move_scores = None
+# Every game played is appended to games.qkr, see records.py
+game_records = RecordWriter()
+
+# Render caches, loading fonts and rendering text and shapes every frame
+# takes most of the frame time
+fonts = {}
+text_images = {}
+piece_sprites = {}
+# Everything but the mouse, redrawn when scene_key changes
+scene = None
+scene_key = None
+
+def get_font(size):
+  if size not in fonts:
+    fonts[size] = pygame.font.SysFont(None, size)
+  return fonts[size]
 
 def draw_text(text, position, color, size=48):
-  font = pygame.font.SysFont(None, size)
-  image = font.render(text, True, color)
+  key = (text, color, size)
+  if key not in text_images:
+    text_images[key] = get_font(size).render(text, True, color)
+  image = text_images[key]
 
   window.blit(image, position)
 
@@ -90,7 +117,7 @@ def draw_board_pieces():
   for row in range(board_grid_size):
     x = board_x_offset + piece_square_size / 2
     for column in range(board_grid_size):
-      position = Vector2(column, row)
+      position = SQUARE_VECTORS[square_index(column, row)]
 
       position_data = game.piece_at(position)
       if position_data:
@@ -174,21 +201,50 @@ def draw_players():
         piece_y_offset += inventory_piece_offset
 
 def draw_piece(piece: PieceType, color: str, center, size: int):
+  key = (piece, color, size)
+  if key not in piece_sprites:
+    sprite_size = math.ceil(size) + 2
+    sprite = pygame.Surface((sprite_size, sprite_size), pygame.SRCALPHA)
+    render_piece(sprite, piece, color, (sprite_size / 2, sprite_size / 2), size)
+    piece_sprites[key] = sprite
+  sprite = piece_sprites[key]
+
+  window.blit(sprite, (center[0] - sprite.get_width() / 2, center[1] - sprite.get_height() / 2))
+
+def render_piece(surface, piece: PieceType, color: str, center, size: int):
   match piece:
     case PieceType.CYLINDER:
-      pygame.draw.circle(window, color, center, size / 2)
+      pygame.draw.circle(surface, color, center, size / 2)
     case PieceType.TRIANGLE:
-      pygame.draw.polygon(window, color, [
+      pygame.draw.polygon(surface, color, [
         [center[0] - size / 2, center[1] + size / 2], # Left bottom
         [center[0] + size / 2, center[1] + size / 2], # Right bottom
         [center[0], center[1] - size / 2] # Center top
       ])
     case PieceType.PLUS:
       bar_size = size / 4
-      pygame.draw.rect(window, color, (center[0] - bar_size / 2, center[1] - size / 2, bar_size, size))
-      pygame.draw.rect(window, color, (center[0] - size / 2, center[1] - bar_size / 2, size, bar_size))
+      pygame.draw.rect(surface, color, (center[0] - bar_size / 2, center[1] - size / 2, bar_size, size))
+      pygame.draw.rect(surface, color, (center[0] - size / 2, center[1] - bar_size / 2, size, bar_size))
     case PieceType.SQUARE:
-      pygame.draw.rect(window, color, (center[0] - size / 2, center[1] - size / 2, size, size))
+      pygame.draw.rect(surface, color, (center[0] - size / 2, center[1] - size / 2, size, size))
+
+def draw_scene():
+  global scene, scene_key
+
+  key = (window.get_size(), game.to_bytes(), selected_piece.type if selected_piece else None)
+  if key == scene_key:
+    window.blit(scene, (0, 0))
+    return
+
+  # fill the window with a color to wipe away anything from last frame
+  window.fill("lightgreen")
+
+  draw_play_board()
+  draw_board_pieces()
+  draw_players()
+
+  scene = window.copy()
+  scene_key = key
 
 def draw_mouse():
   mouse_pos = pygame.mouse.get_pos()
@@ -276,15 +332,23 @@ previous_player = None
 while running:
     if game.active_player != previous_player:
       ai_move_scores = None
-      if player2_is_bot and game.active_player == game.player2:
-        ai = AI(game)
+      if player2_is_bot and game.active_player == game.player2 and game.winner is None:
         print("> Switched to AI")
-        # ai_move_scores = ai.calculate_move_scores(log=False)
-        piece_type, position = ai.calculate_best_move()
-        print(f"{game.active_player.color} player set {piece_type} at {position}")
-        game.set_position(game.active_player.get_piece(piece_type), position)
+        ai_move = ai_service.submit(game)
       previous_player = game.active_player
 
+    # Keep drawing while the AI thinks, its move is played once it's ready
+    if ai_move is not None and ai_move.done():
+      try:
+        piece_type, position = ai_move.result()
+      except Exception as error:
+        # A worker that died, or a tablebase or book file it can't read
+        print(f"> AI worker failed: {error!r}, calculating the move here")
+        piece_type, position = ai_service.fallback_move(game)
+      ai_move = None
+      print(f"{game.active_player.color} player set {piece_type} at {position}")
+      game.set_position(game.active_player.get_piece(piece_type), position)
+
     # poll for events
     # pygame.QUIT event means the user clicked X to close your window
     for event in pygame.event.get():
@@ -294,12 +358,14 @@ while running:
         elif event.type == pygame.MOUSEBUTTONDOWN:
             if event.button == 1:
                   if game.winner is not None or game.in_stale_mate:
+                    game_records.write(game.moves)
                     game = Game()
+                    ai_service.cancel()
+                    ai_move = None
                   else:
                     if player2_is_bot and game.active_player == game.player2:
-                      piece_type, position = ai.calculate_best_move()
-                      print(f"{game.active_player.color} player set {piece_type} at {position}")
-                      game.set_position(game.active_player.get_piece(piece_type), position)
+                      # Wait for the AI
+                      continue
                     else:
                       mouse_interaction = mouse_interaction_with()
                       if mouse_interaction is None:
@@ -308,8 +374,9 @@ while running:
                       section, data = mouse_interaction
                       if section == "board" and selected_piece is not None:
                         # Place piece on location on board
-                        print(f"{game.active_player.color} player set {selected_piece.type} at {Vector2(data[0], data[1])}")
-                        game.set_position(selected_piece, Vector2(data[0], data[1]))
+                        position = Vector2(data[0], data[1])
+                        print(f"{game.active_player.color} player set {selected_piece.type} at {position}")
+                        game.set_position(selected_piece, position)
                         selected_piece = None
                       elif section =="player1" and game.active_player == game.player1:
                         if data < len(game.player1.available_pieces):
@@ -320,22 +387,22 @@ while running:
                           # Clicked on item in Player 2 inventory
                           selected_piece = game.player2.available_pieces[data]
 
-    # fill the window with a color to wipe away anything from last frame
-    window.fill("lightgreen")
-
-    draw_play_board()
-    draw_board_pieces()
-    draw_players()
-
+    draw_scene()
     draw_mouse()
 
     keys = pygame.key.get_pressed()
     if keys[pygame.K_r]:
+      game_records.write(game.moves)
       game = Game()
+      ai_service.cancel()
+      ai_move = None
 
     pygame.display.flip()
 
     # limits FPS to 60
     frame_time = clock.tick(60) / 1000
 
+game_records.write(game.moves)
+game_records.close()
+ai_service.shutdown()
 pygame.quit()
\ No newline at end of file
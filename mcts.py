@@ -0,0 +1,236 @@
+import math
+import random
+import time
+from board import pack_move, unpack_move
+from quantik import Game, SHAPES, SQUARE_VECTORS
+
+class Node:
+  __slots__ = ("move", "parent", "children", "untried", "visits", "value", "result")
+
+  def __init__(self, move=None, parent=None):
+    # The move that led here as board.pack_move, which keeps the nodes small
+    self.move = move
+    self.parent = parent
+    self.children = []
+    # Legal moves that have no child yet, None until the node is expanded
+    self.untried = None
+    self.visits = 0
+    # Sum of the playout results for the player who made move, 1 for a win
+    # and 0.5 for a draw
+    self.value = 0.0
+    # Result for the player who made move when the game ended there, or when
+    # it's proven to end that way: 1.0 when every reply loses, 0.0 when the
+    # opponent has a winning reply
+    self.result = None
+
+class MCTS:
+  game: Game
+
+  # Monte Carlo tree search with UCT selection, an alternative to ai.AI with
+  # the same calculate_best_move. Every calculation runs iterations playouts,
+  # or as many as fit in time_budget milliseconds when that's set. rollout
+  # is "heuristic", which takes immediate wins and avoids handing them to the
+  # opponent, or "random". Most random games end in a stale mate, so random
+  # rollouts tell the moves apart far worse. The tree is kept between calculations, so
+  # the playouts below the previous position are reused when the game
+  # continued from there.
+  def __init__(self, game, iterations=10000, time_budget=None, rollout="heuristic", exploration=math.sqrt(2), rng=None):
+    self.game = game
+    self.iterations = iterations
+    self.time_budget = time_budget
+    self.rollout = rollout
+    self.exploration = exploration
+    self.rng = rng if rng is not None else random
+
+    self.root = None
+    self.root_board = None
+    # Playouts run by the last calculation
+    self.playouts = 0
+
+  def calculate_best_move(self):
+    board = self.game.board.copy()
+    for shape, square in board.legal_moves():
+      if board.winning_line(shape, square):
+        return SHAPES[shape], SQUARE_VECTORS[square]
+
+    self.root = self.reused_root(board)
+    self.root.parent = None
+    self.root_board = board.copy()
+
+    deadline = None
+    if self.time_budget is not None:
+      deadline = time.perf_counter() + self.time_budget / 1000
+
+    self.playouts = 0
+    # Stops early once every move is proven lost
+    while self.root.result is None:
+      if deadline is not None:
+        if self.playouts and self.playouts & 0x3F == 0 and time.perf_counter() > deadline:
+          break
+      elif self.playouts >= self.iterations:
+        break
+
+      self.playout(board)
+      self.playouts += 1
+
+    # Moves that give the opponent a winning reply are only played when
+    # every move does
+    children = [child for child in self.root.children if child.result != 0.0] or self.root.children
+    best = max(children, key=lambda x: x.visits)
+    shape, square = unpack_move(best.move)
+    return SHAPES[shape], SQUARE_VECTORS[square]
+
+  # Node of the board in the tree of the previous calculation when the game
+  # got there in at most two moves, else a new tree
+  def reused_root(self, board):
+    if self.root is None:
+      return Node()
+
+    previous = self.root_board
+    if previous.encode() == board.encode():
+      return self.root
+
+    turn = previous.turn
+    found = None
+    for child in self.root.children:
+      shape, square = unpack_move(child.move)
+      previous.place(turn, shape, square)
+      if previous.key == board.key and previous.encode() == board.encode():
+        found = child
+      else:
+        for grandchild in child.children:
+          other_shape, other_square = unpack_move(grandchild.move)
+          previous.place(turn ^ 1, other_shape, other_square)
+          if previous.key == board.key and previous.encode() == board.encode():
+            found = grandchild
+          previous.remove(turn ^ 1, other_shape, other_square)
+          if found is not None:
+            break
+      previous.remove(turn, shape, square)
+      if found is not None:
+        return found
+    return Node()
+
+  def select(self, node):
+    log_visits = math.log(node.visits)
+    exploration = self.exploration
+    best = None
+    best_score = -1.0
+    for child in node.children:
+      score = child.value / child.visits + exploration * math.sqrt(log_visits / child.visits)
+      if score > best_score:
+        best = child
+        best_score = score
+    return best
+
+  # Walks down the tree to a new or finished node, plays the game out from
+  # there and adds the result to every node on the way. The board is back
+  # where it started afterwards.
+  def playout(self, board):
+    node = self.root
+    placed = []
+    while node.result is None:
+      if node.untried is None:
+        moves = board.legal_moves()
+        # No legal moves is a stale mate
+        if not moves:
+          node.result = 0.5
+          break
+        # A winning move for the player to move loses the game for the
+        # player who got here, without expanding the node
+        if any(board.winning_line(shape, square) for shape, square in moves):
+          node.result = 0.0
+          self.prove(node)
+          break
+        node.untried = [pack_move(shape, square) for shape, square in moves]
+
+      if node.untried:
+        move = node.untried.pop(self.rng.randrange(len(node.untried)))
+        node = self.add_child(node, move, board, placed)
+        break
+
+      node = self.select(node)
+      self.place(board, node.move, placed)
+
+    if node.result is not None:
+      result = node.result
+    else:
+      result = self.play_out(board)
+
+    while placed:
+      player, shape, square = placed.pop()
+      board.remove(player, shape, square)
+
+    while node is not None:
+      node.visits += 1
+      node.value += result
+      result = 1 - result
+      node = node.parent
+
+  def add_child(self, node, move, board, placed):
+    child = Node(move, node)
+    node.children.append(child)
+    self.place(board, move, placed)
+    return child
+
+  # Marks the ancestors whose result follows from the proven result of node:
+  # a move that wins makes its parent lost for whoever moved there, and a
+  # parent whose moves all lose is won for whoever moved there
+  def prove(self, node):
+    parent = node.parent
+    while parent is not None and parent.result is None:
+      if node.result == 1.0:
+        parent.result = 0.0
+      elif node.result == 0.0 and not parent.untried and all(child.result == 0.0 for child in parent.children):
+        parent.result = 1.0
+      else:
+        break
+      node, parent = parent, parent.parent
+
+  def place(self, board, move, placed):
+    shape, square = unpack_move(move)
+    placed.append((board.turn, shape, square))
+    board.place(board.turn, shape, square)
+
+  # Result of a rollout from the board for the player who made the last move
+  def play_out(self, board):
+    player = board.turn ^ 1
+    placed = []
+    result = 0.5
+    while True:
+      moves = board.legal_moves()
+      if not moves:
+        break
+
+      shape, square = self.rollout_move(board, moves)
+      if board.winning_line(shape, square):
+        result = 1.0 if board.turn == player else 0.0
+        break
+
+      placed.append((board.turn, shape, square))
+      board.place(board.turn, shape, square)
+
+    while placed:
+      board.remove(*placed.pop())
+    return result
+
+  def rollout_move(self, board, moves):
+    if self.rollout == "heuristic":
+      for shape, square in moves:
+        if board.winning_line(shape, square):
+          return shape, square
+
+      safe_moves = [(shape, square) for shape, square in moves if not board.gives_win(shape, square)]
+      if safe_moves:
+        moves = safe_moves
+    return self.rng.choice(moves)
+
+  # Number of nodes in the tree
+  def tree_size(self):
+    size = 0
+    nodes = [self.root] if self.root is not None else []
+    while nodes:
+      node = nodes.pop()
+      size += 1
+      nodes.extend(node.children)
+    return size
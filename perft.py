@@ -0,0 +1,179 @@
+import argparse
+import sys
+import time
+from bench import CORPORA, corpus_games
+from quantik import Game, SHAPES, SHAPE_INDEX, SQUARE_VECTORS, square_of
+
+# Engines answer the two rule questions, legal moves and winning moves, for
+# a Game. Moves are (PieceType, Vector2) for every engine.
+
+class GameEngine:
+  name = "game"
+
+  def moves(self, game):
+    moves = []
+    for vector in SQUARE_VECTORS:
+      pieces = game.allowed_pieces_at(vector)
+      if pieces is None:
+        continue
+      for piece in pieces[game.active_player]:
+        moves.append((piece.type, vector))
+    return moves
+
+  def is_winning(self, game, move):
+    piece_type, vector = move
+    return game.is_winning_move(game.active_player.get_piece(piece_type), vector)[0]
+
+class BoardEngine:
+  name = "board"
+
+  def moves(self, game):
+    return [(SHAPES[shape], SQUARE_VECTORS[square]) for shape, square in game.board.legal_moves()]
+
+  def is_winning(self, game, move):
+    piece_type, vector = move
+    return bool(game.board.winning_line(SHAPE_INDEX[piece_type], square_of(vector)))
+
+# The rules as written out in interesting_positions_for, checked square by
+# square through piece_at
+class ReferenceEngine:
+  name = "reference"
+
+  def moves(self, game):
+    moves = []
+    for vector in SQUARE_VECTORS:
+      if game.piece_at(vector) is not None:
+        continue
+
+      excluded = set()
+      for position in game.interesting_positions_for(vector)[3]:
+        occupant = game.piece_at(position)
+        if occupant is not None:
+          excluded.add(occupant[0].type)
+
+      for piece in game.active_player.available_pieces:
+        if piece.type not in excluded:
+          moves.append((piece.type, vector))
+    return moves
+
+  def is_winning(self, game, move):
+    piece_type, vector = move
+    for positions in game.interesting_positions_for(vector)[:3]:
+      types = {piece_type}
+      for position in positions:
+        occupant = game.piece_at(position)
+        if occupant is not None:
+          types.add(occupant[0].type)
+      if len(types) == 4:
+        return True
+    return False
+
+ENGINES = {engine.name: engine for engine in (GameEngine(), BoardEngine(), ReferenceEngine())}
+
+# Number of positions exactly depth plies after the game, games that end
+# earlier don't count. The engines only list legal moves, so they're played
+# with apply_move.
+def perft(game, depth, engine=ENGINES["game"]):
+  if depth == 0:
+    return 1
+  if game.winner is not None:
+    return 0
+
+  nodes = 0
+  for piece_type, vector in engine.moves(game):
+    if depth == 1:
+      nodes += 1
+      continue
+
+    game.apply_move((piece_type, vector))
+    nodes += perft(game, depth - 1, engine)
+    game.undo_move((piece_type, vector))
+  return nodes
+
+# perft of every root move, as a list of ((PieceType, Vector2), count)
+def divide(game, depth, engine=ENGINES["game"]):
+  counts = []
+  if game.winner is not None:
+    return counts
+
+  for piece_type, vector in engine.moves(game):
+    game.apply_move((piece_type, vector))
+    counts.append(((piece_type, vector), perft(game, depth - 1, engine)))
+    game.undo_move((piece_type, vector))
+  return counts
+
+def _move_keys(moves):
+  return sorted((piece_type.value, vector.x, vector.y) for piece_type, vector in moves)
+
+# Walks every line up to depth and compares both engines on the way.
+# Returns the first position where they disagree or None.
+def compare(game, depth, engine, other_engine, moves_played=()):
+  if game.winner is not None:
+    return None
+
+  moves = engine.moves(game)
+  other_moves = other_engine.moves(game)
+  if _move_keys(moves) != _move_keys(other_moves):
+    return {
+      "moves": list(moves_played),
+      "position": game.dump(),
+      "only_" + engine.name: [move for move in _move_keys(moves) if move not in _move_keys(other_moves)],
+      "only_" + other_engine.name: [move for move in _move_keys(other_moves) if move not in _move_keys(moves)]
+    }
+
+  for move in moves:
+    is_winning = engine.is_winning(game, move)
+    if is_winning != other_engine.is_winning(game, move):
+      return {
+        "moves": list(moves_played),
+        "position": game.dump(),
+        "move": _move_keys([move])[0],
+        engine.name + "_wins": is_winning,
+        other_engine.name + "_wins": not is_winning
+      }
+
+    if depth > 1 and not is_winning:
+      piece_type, vector = move
+      game.apply_move(move)
+      disagreement = compare(game, depth - 1, engine, other_engine, moves_played + ((piece_type.value, vector.x, vector.y),))
+      game.undo_move(move)
+      if disagreement is not None:
+        return disagreement
+  return None
+
+def main():
+  parser = argparse.ArgumentParser(description="Count Quantik positions per depth from the start of the game")
+  parser.add_argument("--depth", type=int, default=4)
+  parser.add_argument("--engine", choices=list(ENGINES), default="game")
+  parser.add_argument("--divide", action="store_true", help="break the deepest count down per first move")
+  parser.add_argument("--compare", choices=list(ENGINES), help="check the engine against this one up to the depth")
+  parser.add_argument("--corpus", choices=list(CORPORA), help="start from the benchmark positions instead of an empty board")
+  args = parser.parse_args()
+
+  engine = ENGINES[args.engine]
+  games = corpus_games(args.corpus) if args.corpus else [Game()]
+
+  if args.compare:
+    start = time.perf_counter()
+    for game in games:
+      disagreement = compare(game, args.depth, engine, ENGINES[args.compare])
+      if disagreement is not None:
+        print(f"{engine.name} and {args.compare} disagree after {disagreement['moves']}")
+        print(disagreement)
+        return 1
+    print(f"{engine.name} and {args.compare} agree up to depth {args.depth} ({time.perf_counter() - start:.1f}s)")
+    return
+
+  for depth in range(1, args.depth + 1):
+    start = time.perf_counter()
+    nodes = sum(perft(game, depth, engine) for game in games)
+    elapsed = time.perf_counter() - start
+    print(f"depth {depth}: {nodes:>12,} positions in {elapsed:8.2f}s, {nodes / elapsed:12,.0f} positions/s")
+
+  if args.divide:
+    for game in games:
+      for (piece_type, vector), nodes in divide(game, args.depth, engine):
+        print(f"  {piece_type.value:8} ({vector.x}, {vector.y}): {nodes:,}")
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -1,6 +1,8 @@
 from dataclasses import dataclass
 from enum import Enum
-from utils import flatten, Vector2
+from utils import Vector2
+from board import Board, LINE_MASKS, LINE_SQUARES, SHAPE_COUNT, SQUARE_COUNT, SQUARE_PEERS, mask_of, on_board, square_index, square_position
+from symmetry import canonicalize
 import json
 
 class PieceType(Enum):
@@ -9,26 +11,58 @@ class PieceType(Enum):
   PLUS = "Plus"
   SQUARE = "Square"
 
-@dataclass
+# Board shape index of every piece type
+SHAPES = list(PieceType)
+SHAPE_INDEX = {piece_type: shape for shape, piece_type in enumerate(SHAPES)}
+
+# The board squares, interned: every position the game stores is one of
+# these, so they compare by identity and carry their square index
+SQUARE_VECTORS = tuple(Vector2(*square_position(square), square) for square in range(SQUARE_COUNT))
+# PEER_VECTORS[square] -> vectors of the row, column and quadrant peers in
+# board.SQUARE_PEERS, followed by all of them
+PEER_VECTORS = tuple(
+  tuple(tuple(SQUARE_VECTORS[peer] for peer in peers) for peers in (row, column, quadrant, row + column + quadrant))
+  for row, column, quadrant in SQUARE_PEERS
+)
+# Vectors of the squares of every row, column and quadrant by mask
+LINE_VECTORS = {mask: tuple(SQUARE_VECTORS[square] for square in squares) for mask, squares in LINE_SQUARES.items()}
+
+# Game.to_bytes: Board.encode() with the completed line (index into
+# LINE_MASKS + 1, 0 while nobody won) above it
+ENCODED_SIZE = 9
+LINE_SHIFT = 4 * SQUARE_COUNT + 1
+
+def square_of(position):
+  square = position.square
+  if square is None:
+    return square_index(position.x, position.y)
+  return square
+
+@dataclass(frozen=True, slots=True)
 class Piece:
   type: PieceType
   position: Vector2 = None
 
+# Pieces are values, a player swaps them on a move. PLACED_PIECES[shape][square]
+# -> the piece of that shape on that square, UNPLACED_PIECES[shape] -> the
+# piece off the board.
+PLACED_PIECES = tuple(tuple(Piece(piece_type, position) for position in SQUARE_VECTORS) for piece_type in SHAPES)
+UNPLACED_PIECES = tuple(Piece(piece_type) for piece_type in SHAPES)
+# Player attribute holding the piece of every shape
+PIECE_ATTRIBUTES = tuple(piece_type.name.lower() for piece_type in SHAPES)
+
 class Player:
   color: str
 
   cylinder: Piece
   triangle: Piece
-  orb: Piece
+  plus: Piece
   square: Piece
 
   def __init__(self, color: str):
     self.color = color
 
-    self.cylinder = Piece(PieceType.CYLINDER)
-    self.triangle = Piece(PieceType.TRIANGLE)
-    self.plus = Piece(PieceType.PLUS)
-    self.square = Piece(PieceType.SQUARE)
+    self.cylinder, self.triangle, self.plus, self.square = UNPLACED_PIECES
 
   @property
   def name(self):
@@ -45,29 +79,39 @@ class Player:
 
   @property
   def available_pieces(self):
-    return list(filter(lambda x: x.position == None, self.pieces))
+    return list(filter(lambda x: x.position is None, self.pieces))
 
   @property
   def used_pieces(self):
-    return list(filter(lambda x: x.position != None, self.pieces))
+    return list(filter(lambda x: x.position is not None, self.pieces))
 
   def get_piece(self, type: PieceType):
-    return list(filter(lambda x: x.type == type, self.pieces))[0]
+    return getattr(self, PIECE_ATTRIBUTES[SHAPE_INDEX[type]])
+
+  # Puts the piece of the type on position, None takes it off the board
+  def set_piece_position(self, type: PieceType, position):
+    shape = SHAPE_INDEX[type]
+    if position is None:
+      piece = UNPLACED_PIECES[shape]
+    else:
+      piece = PLACED_PIECES[shape][square_of(position)]
+    setattr(self, PIECE_ATTRIBUTES[shape], piece)
 
 class Game:
   player1: Player
   player2: Player
-  active_player: Player
+  board: Board
   winner = None
 
   def __init__(self, data=None):
+    self.board = Board()
+    # (PieceType, Vector2) of the moves played on this game, a game loaded
+    # from data or bytes starts without them
+    self.moves = []
+
     if data:
       self.player1 = Player(color=data["player1"]["color"])
       self.player2 = Player(color=data["player2"]["color"])
-      if data["active_player"] == self.player1.color:
-        self.active_player = self.player1
-      else:
-        self.active_player = self.player2
 
       moves = {
         self.player1.color: data["player1"]["pieces"],
@@ -84,13 +128,19 @@ class Game:
           if position is None:
             continue
           piece_type = PieceType(piece_type_value)
+          square = square_index(position[0], position[1])
 
-          piece = player.get_piece(piece_type)
-          piece.position = Vector2(position[0], position[1])
+          player.set_piece_position(piece_type, SQUARE_VECTORS[square])
+          self.board.place(self.player_index(player), SHAPE_INDEX[piece_type], square)
+
+      # Pieces are placed in any order, the player to move comes from the data
+      if data["active_player"] == self.player1.color:
+        self.board.set_turn(0)
+      else:
+        self.board.set_turn(1)
     else:
       self.player1 = Player(color="white")
       self.player2 = Player(color="black")
-      self.active_player = self.player1
 
   def dump(self, to_file=False):
     def player_pieces(player):
@@ -114,129 +164,163 @@ class Game:
       "active_player": self.active_player.color
     }
 
-    data_json = json.dumps(data, indent=2)
     if to_file:
       with open("game.json", "w") as outfile:
-        outfile.write(data_json)
-    # else:
-    #   print("")
-    #   print(data_json)
-    #   print("")
+        outfile.write(json.dumps(data, indent=2))
 
     return data
 
+  # Fixed width encoding of the position, the players are white and black.
+  # Equal games give equal bytes, so it doubles as a dict key.
+  def to_bytes(self):
+    value = self.board.encode()
+    if self.winner is not None:
+      line = mask_of(square_of(position) for position in self.winner[1])
+      value |= (LINE_MASKS.index(line) + 1) << LINE_SHIFT
+    return value.to_bytes(ENCODED_SIZE, "big")
+
+  @classmethod
+  def from_bytes(cls, data):
+    value = int.from_bytes(data, "big")
+    game = cls()
+    game.board = Board.decode(value & ((1 << LINE_SHIFT) - 1))
+
+    for player, masks in zip(game.players, game.board.pieces):
+      for shape, mask in enumerate(masks):
+        if mask:
+          setattr(player, PIECE_ATTRIBUTES[shape], PLACED_PIECES[shape][mask.bit_length() - 1])
+
+    line = value >> LINE_SHIFT
+    if line:
+      # The player who moved last completed the line
+      game.winner = (game.inactive_player, LINE_VECTORS[LINE_MASKS[line - 1]])
+    return game
+
   def clone(self):
-    return Game(data=self.dump())
+    return Game.from_bytes(self.to_bytes())
 
   @property
   def players(self):
     return [self.player1, self.player2]
 
+  def player_index(self, player):
+    return 0 if player is self.player1 else 1
+
+  @property
+  def active_player(self):
+    return self.player1 if self.board.turn == 0 else self.player2
+
   @property
   def inactive_player(self):
-    return list(filter(lambda x: x != self.active_player, self.players))[0]
+    return self.player2 if self.board.turn == 0 else self.player1
 
   def toggle_active_player(self):
-    if self.active_player == self.player1:
-      self.active_player = self.player2
-    else:
-      self.active_player = self.player1
+    self.board.set_turn(self.board.turn ^ 1)
 
+  @property
+  def key(self):
+    return self.board.key
+
+  # Encoding of the representative of all symmetric positions and the
+  # symmetry.Transform from this position to it
+  def canonical(self):
+    return canonicalize(self.board)
+
+  # No winner and no legal move for the active player, either out of pieces
+  # or every free square blocks the shapes left
   @property
   def in_stale_mate(self):
     if self.winner is not None:
       return False
 
-    return len(self.active_player.available_pieces) == 0
+    return not self.board.has_legal_move()
+
+  # Yields the (piece type, position) of every legal move of the active
+  # player, by square. Nothing is yielded once the game is won.
+  def legal_moves(self):
+    if self.winner is not None:
+      return
+
+    board = self.board
+    pieces = board.pieces[board.turn]
+    legal_squares = [0 if pieces[shape] else board.legal_squares(shape) for shape in range(SHAPE_COUNT)]
+    for square in range(SQUARE_COUNT):
+      bit = 1 << square
+      for shape in range(SHAPE_COUNT):
+        if legal_squares[shape] & bit:
+          yield SHAPES[shape], SQUARE_VECTORS[square]
 
   def set_position(self, piece, position):
     if self.winner is not None:
       return False
 
-    if self.piece_at(position) != None:
+    if not on_board(position.x, position.y):
       return False
 
-    if piece.type not in set(map(lambda x: x.type, flatten(self.allowed_pieces_at(position).values()))):
+    if not self.board.is_legal(self.board.turn, SHAPE_INDEX[piece.type], square_of(position)):
       return False
 
-    is_winning_move, winning_move_pieces = self.is_winning_move(piece, position)
-    if is_winning_move:
-      self.winner = (self.active_player, winning_move_pieces)
+    return self.apply_move((piece.type, position))
 
-    piece.position = position
+  # Places the piece of the active player without validating the move,
+  # set_position is the checked entry point for user input
+  def apply_move(self, move):
+    piece_type, position = move
+    square = square_of(position)
+    shape = SHAPE_INDEX[piece_type]
+    player = self.active_player
 
-    self.toggle_active_player()
+    line = self.board.winning_line(shape, square)
+    if line:
+      self.winner = (player, LINE_VECTORS[line])
 
-    return is_winning_move
+    self.board.place(self.board.turn, shape, square)
+    position = SQUARE_VECTORS[square]
+    player.set_piece_position(piece_type, position)
+    self.moves.append((piece_type, position))
 
-  def piece_at(self, position):
-    for player in self.players:
-      for piece in player.used_pieces:
-        if piece.position == position:
-          return (piece, player)
+    return bool(line)
 
-    return None
+  # Reverts the last apply_move, a move can only be applied while there's no winner
+  def undo_move(self, move):
+    piece_type, position = move
+    self.board.remove(self.board.turn ^ 1, SHAPE_INDEX[piece_type], square_of(position))
+    self.active_player.set_piece_position(piece_type, None)
+    self.winner = None
+    self.moves.pop()
 
-  # def print_pieces(self):
-  #   for player in self.players:
-  #     for piece in player.used_pieces:
-  #       # if piece.position == position:
-  #       #   return (piece, player)
-  #       print(piece.position, piece)
+  def piece_at(self, position):
+    if not on_board(position.x, position.y):
+      return None
+
+    occupant = self.board.piece_at(square_of(position))
+    if occupant is None:
+      return None
 
-  #   return None
+    player = self.players[occupant[0]]
+    return (player.get_piece(SHAPES[occupant[1]]), player)
 
   def allowed_pieces_at(self, position):
     if self.piece_at(position) is not None:
       return None
 
-    _, _, _, exclude_positions = self.interesting_positions_for(position)
-    exclude_pieces_orig = list(map(lambda x: self.piece_at(x), exclude_positions))
-    exclude_pieces = set([piece[0].type for piece in exclude_pieces_orig if piece is not None])
+    allowed_shapes = self.board.allowed_shapes(square_of(position))
 
     pieces = {}
     for player in self.players:
-      pieces[player] = list(filter(lambda x: x.type not in exclude_pieces, player.available_pieces))
+      pieces[player] = list(filter(lambda x: allowed_shapes & (1 << SHAPE_INDEX[x.type]), player.available_pieces))
 
     return pieces
 
   def interesting_positions_for(self, position):
-    horizontal_exclusions = [(column, position.y) for column in range(4) if column != position.x]
-    vertical_exclusions = [(position.x, row) for row in range(4) if row != position.y]
-
-    column = position.x
-    row = position.y
-    if (column < 2 and row < 2): # Left top
-      quadrant_exclusions = [(0, 0), (1, 0), (0, 1), (1, 1)]
-    elif (column < 2 and row >= 2): # Left bottom
-      quadrant_exclusions = [(0, 2), (1, 2), (0, 3), (1, 3)]
-    elif (column >= 2 and row < 2): # Right top
-      quadrant_exclusions = [(2, 0), (3, 0), (2, 1), (3, 1)]
-    elif (column >= 2 and row >= 2): # Right bottom)
-      quadrant_exclusions = [(2, 2), (3, 2), (2, 3), (3, 3)]
-    else:
+    if not on_board(position.x, position.y):
       raise Exception(f"Can't determine quadrant for position {position}")
-    if position in quadrant_exclusions:
-      quadrant_exclusions.remove(position)
 
-    horizontal_vectors = list(map(lambda x: Vector2(x[0], x[1]), horizontal_exclusions))
-    vertical_vectors = list(map(lambda x: Vector2(x[0], x[1]), vertical_exclusions))
-    quadrant_vectors = list(map(lambda x: Vector2(x[0], x[1]), quadrant_exclusions))
-    all_vectors = horizontal_vectors + vertical_vectors + quadrant_vectors
-
-    return horizontal_vectors, vertical_vectors, quadrant_vectors, all_vectors
+    return PEER_VECTORS[square_of(position)]
 
   def is_winning_move(self, piece, position):
-    piece.position = position
-
-    for positions in self.interesting_positions_for(position)[:-1]:
-      section_pieces = positions + [position]
-      pieces = list(map(lambda x: self.piece_at(x), section_pieces))
-      pieces = set([piece[0].type for piece in pieces if piece is not None])
-
-      if len(pieces) == 4:
-        piece.position = None
-        return True, section_pieces
+    line = self.board.winning_line(SHAPE_INDEX[piece.type], square_of(position))
+    if line:
+      return True, LINE_VECTORS[line]
 
-    piece.position = None
-    return False, None
\ No newline at end of file
+    return False, None
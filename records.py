@@ -0,0 +1,103 @@
+import argparse
+import struct
+import sys
+import time
+from board import pack_move, unpack_move
+from quantik import Game, SHAPES, SHAPE_INDEX, SQUARE_VECTORS, square_of
+
+# Game records, appended one game at a time: the header once at the start of
+# the file, then for every game its number of moves followed by the moves,
+# one board.pack_move byte each
+DEFAULT_PATH = "games.qkr"
+
+MAGIC = b"QKGR"
+VERSION = 1
+HEADER = struct.Struct("<4sH")
+
+def encode_move(move):
+  piece_type, position = move
+  return pack_move(SHAPE_INDEX[piece_type], square_of(position))
+
+def decode_move(value):
+  shape, square = unpack_move(value)
+  return SHAPES[shape], SQUARE_VECTORS[square]
+
+class RecordWriter:
+  def __init__(self, path=DEFAULT_PATH):
+    self.file = open(path, "ab")
+    if self.file.tell() == 0:
+      self.file.write(HEADER.pack(MAGIC, VERSION))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  # Appends the (PieceType, Vector2) moves of a game, games without moves
+  # aren't recorded
+  def write(self, moves):
+    if not moves:
+      return
+    self.file.write(bytes([len(moves)]) + bytes(encode_move(move) for move in moves))
+    self.file.flush()
+
+  def close(self):
+    self.file.close()
+
+# Yields the moves of every game in the file, one game at a time
+def read_records(path=DEFAULT_PATH):
+  with open(path, "rb") as infile:
+    header = infile.read(HEADER.size)
+    if len(header) < HEADER.size:
+      return
+    magic, version = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+      raise Exception(f"{path} is not a version {VERSION} Quantik game record file")
+
+    while True:
+      length = infile.read(1)
+      if not length:
+        return
+      data = infile.read(length[0])
+      if len(data) < length[0]:
+        raise Exception(f"{path} ends in the middle of a game")
+      yield [decode_move(value) for value in data]
+
+# Yields every game in the file played out with Game.set_position
+def replay(path=DEFAULT_PATH):
+  for index, moves in enumerate(read_records(path)):
+    game = Game()
+    for ply, (piece_type, position) in enumerate(moves):
+      game.set_position(game.active_player.get_piece(piece_type), position)
+      if len(game.moves) == ply:
+        raise Exception(f"Game {index} in {path} has an illegal move, {piece_type.value} at {position}")
+    yield game
+
+def main():
+  parser = argparse.ArgumentParser(description="Replay recorded Quantik games and summarize them")
+  parser.add_argument("path", nargs="?", default=DEFAULT_PATH)
+  args = parser.parse_args()
+
+  start = time.perf_counter()
+  games = 0
+  plies = 0
+  results = {}
+  for game in replay(args.path):
+    games += 1
+    plies += len(game.moves)
+    if game.winner is not None:
+      result = f"{game.winner[0].color} wins"
+    elif game.in_stale_mate:
+      result = "stale mate"
+    else:
+      result = "unfinished"
+    results[result] = results.get(result, 0) + 1
+  elapsed = time.perf_counter() - start
+
+  print(f"{games} games in {elapsed:.2f}s, {games / elapsed if elapsed else 0:.0f} games/s, {plies / games if games else 0:.1f} plies/game")
+  for result, count in sorted(results.items()):
+    print(f"  {result} {count / games:.1%}")
+
+if __name__ == "__main__":
+  sys.exit(main())
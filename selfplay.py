@@ -0,0 +1,133 @@
+import argparse
+import json
+import random
+import sys
+import time
+from ai import AI, process_pool
+from mcts import MCTS
+from board import square_index
+from quantik import Game, PieceType, SHAPES, SQUARE_VECTORS
+from records import RecordWriter
+from tablebase import Tablebase
+from transposition import TranspositionTable
+
+# Tablebase of this process, opened on the first game that needs it
+_tablebase = None
+
+def _open_tablebase(path):
+  global _tablebase
+  if path is not None and _tablebase is None:
+    _tablebase = Tablebase(path)
+  return _tablebase
+
+# Plays one game from the start, the players are "ai", "mcts" or "random".
+# Returns the record of the game.
+def play_game(index, seed, players, depth=2, time_budget=None, tablebase_path=None, iterations=10000):
+  rng = random.Random(f"{seed}:{index}")
+  tablebase = _open_tablebase(tablebase_path)
+  table = TranspositionTable()
+
+  game = Game()
+  # Every MCTS player keeps its tree for the whole game
+  engines = [MCTS(game, iterations=iterations, time_budget=time_budget, rng=rng) if player == "mcts" else None for player in players]
+  moves = []
+  move_ms = []
+  nodes = 0
+  while game.winner is None and not game.in_stale_mate:
+    legal_moves = game.board.legal_moves()
+
+    start = time.perf_counter()
+    if players[game.board.turn] == "random":
+      shape, square = rng.choice(legal_moves)
+      piece_type, position = SHAPES[shape], SQUARE_VECTORS[square]
+    elif players[game.board.turn] == "mcts":
+      piece_type, position = engines[game.board.turn].calculate_best_move()
+    else:
+      ai = AI(game, depth=depth, table=table, tablebase=tablebase, time_budget=time_budget, rng=rng)
+      piece_type, position = ai.calculate_best_move()
+      nodes += ai.nodes
+    move_ms.append((time.perf_counter() - start) * 1000)
+
+    moves.append([piece_type.value, position.x, position.y])
+    game.set_position(game.active_player.get_piece(piece_type), position)
+
+  winner = None
+  if game.winner is not None:
+    winner = game.winner[0].color
+
+  return {
+    "game": index,
+    "seed": seed,
+    "players": {game.player1.color: players[0], game.player2.color: players[1]},
+    "winner": winner,
+    "winner_player": players[game.player_index(game.winner[0])] if winner else None,
+    "plies": len(moves),
+    "moves": moves,
+    "move_ms": move_ms,
+    "nodes": nodes
+  }
+
+def _play_game(arguments):
+  return play_game(*arguments)
+
+def main():
+  parser = argparse.ArgumentParser(description="Play Quantik games without a window, one JSON record per game is written to stdout")
+  parser.add_argument("--games", type=int, default=100)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--opponent", choices=["ai", "mcts", "random"], default="ai", help="an opponent other than ai switches colors every game")
+  parser.add_argument("--depth", type=int, default=2, help="0 searches until the end of the game")
+  parser.add_argument("--time-budget", type=float, help="milliseconds per AI move")
+  parser.add_argument("--iterations", type=int, default=10000, help="playouts per MCTS move without a time budget")
+  parser.add_argument("--tablebase", help="path of a tablebase for the AI")
+  parser.add_argument("--workers", type=int, help="play games in this many processes")
+  parser.add_argument("--output", type=argparse.FileType("w"), default=sys.stdout)
+  parser.add_argument("--record", help="also append the moves of every game to this game record file")
+  args = parser.parse_args()
+
+  depth = args.depth or None
+  games = []
+  for index in range(args.games):
+    players = ("ai", "ai")
+    if args.opponent != "ai":
+      players = ("ai", args.opponent) if index % 2 == 0 else (args.opponent, "ai")
+    games.append((index, args.seed, players, depth, args.time_budget, args.tablebase, args.iterations))
+
+  start = time.perf_counter()
+  if args.workers:
+    records = process_pool(args.workers).map(_play_game, games, chunksize=max(1, args.games // (args.workers * 8)))
+  else:
+    records = map(_play_game, games)
+
+  total_nodes = 0
+  total_plies = 0
+  colors = {}
+  players = {}
+  draws = 0
+  writer = RecordWriter(args.record) if args.record else None
+  for record in records:
+    args.output.write(json.dumps(record) + "\n")
+    args.output.flush()
+    if writer is not None:
+      writer.write([(PieceType(piece_type), SQUARE_VECTORS[square_index(x, y)]) for piece_type, x, y in record["moves"]])
+
+    total_nodes += record["nodes"]
+    total_plies += record["plies"]
+    if record["winner"] is None:
+      draws += 1
+    else:
+      colors[record["winner"]] = colors.get(record["winner"], 0) + 1
+      players[record["winner_player"]] = players.get(record["winner_player"], 0) + 1
+  elapsed = time.perf_counter() - start
+  if writer is not None:
+    writer.close()
+
+  print(f"{args.games} games in {elapsed:.2f}s, {args.games / elapsed:.1f} games/s, {total_nodes / elapsed:.0f} nodes/s, {total_plies / args.games:.1f} plies/game", file=sys.stderr)
+  for color, wins in sorted(colors.items()):
+    print(f"  {color} wins {wins / args.games:.1%}", file=sys.stderr)
+  if args.opponent != "ai":
+    for player, wins in sorted(players.items()):
+      print(f"  {player} player wins {wins / args.games:.1%}", file=sys.stderr)
+  print(f"  draws {draws / args.games:.1%}", file=sys.stderr)
+
+if __name__ == "__main__":
+  sys.exit(main())
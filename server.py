@@ -0,0 +1,411 @@
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from ai import MAX_DEPTH, worker_context
+from ai_service import calculate_best_move
+from board import on_board, square_index
+from book import DEFAULT_PATH as BOOK_PATH
+from quantik import Game, PieceType, SQUARE_VECTORS
+from tablebase import DEFAULT_PATH as TABLEBASE_PATH
+
+# Headless Quantik server. Clients send one JSON object per line and get one
+# JSON object per line back, in order, with the "id" of the request:
+#
+#   {"id": 1, "op": "new", "ai": "black", "depth": 2, "timeout": 5}
+#   {"id": 2, "op": "move", "session": 1, "move": ["Cylinder", 0, 0]}
+#   {"id": 3, "op": "ai", "session": 1}
+#   {"id": 4, "op": "state", "session": 1}
+#   {"id": 5, "op": "close", "session": 1}
+#   {"id": 6, "op": "metrics"}
+#
+# Answers are {"id", "ok": true, ...} or {"id", "ok": false, "error"}. Moves
+# are [piece type value, x, y] like selfplay.py writes them. A move in a
+# session where the AI plays the other color is answered once the AI moved,
+# with its move in "ai_move". Sessions belong to the connection that opened
+# them and end with it, a client opens a connection per session it wants to
+# play at the same time.
+DEFAULT_PORT = 7878
+
+# AI move latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+
+COLORS = ("white", "black")
+
+class ProtocolError(Exception):
+  pass
+
+# The AI worker raised or died while calculating a move
+class AIError(Exception):
+  pass
+
+# Value at fraction (0.99 for p99) of the sorted values, nearest rank
+def percentile(values, fraction):
+  if not values:
+    return 0.0
+  values = sorted(values)
+  return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+def encode_move(move):
+  piece_type, position = move
+  return [piece_type.value, position.x, position.y]
+
+def decode_move(value):
+  try:
+    piece_type, x, y = value
+    piece_type = PieceType(piece_type)
+  except (TypeError, ValueError):
+    raise ProtocolError(f"{value} is not a [piece type, x, y] move")
+  # JSON true and false are ints to Python
+  if any(not isinstance(coordinate, int) or isinstance(coordinate, bool) for coordinate in (x, y)) or not on_board(x, y):
+    raise ProtocolError(f"{value} is not on the board")
+  return piece_type, SQUARE_VECTORS[square_index(x, y)]
+
+def game_state(game):
+  return {
+    # Game.to_bytes() as hex, Game.from_bytes(bytes.fromhex(position))
+    # restores the game on the client
+    "position": game.to_bytes().hex(),
+    "turn": game.active_player.color,
+    "winner": game.winner[0].color if game.winner is not None else None,
+    "stale_mate": game.in_stale_mate,
+    "moves": [encode_move(move) for move in game.moves]
+  }
+
+class Metrics:
+  def __init__(self):
+    self.sessions = 0
+    self.sessions_opened = 0
+    self.moves = 0
+    self.ai_moves = 0
+    # AI moves that missed the timeout of their session, and that failed in
+    # their worker
+    self.timeouts = 0
+    self.ai_errors = 0
+    # AI moves submitted to the pool and not finished yet, and requests
+    # waiting for room in the pool
+    self.queue_depth = 0
+    self.queue_waiting = 0
+    self.peak_queue_depth = 0
+    # Milliseconds from asking for an AI move to getting it, queueing included
+    self.latencies_ms = deque(maxlen=LATENCY_WINDOW)
+    self.started = time.perf_counter()
+
+  def as_dict(self):
+    latencies = list(self.latencies_ms)
+    return {
+      "sessions": self.sessions,
+      "sessions_opened": self.sessions_opened,
+      "moves": self.moves,
+      "ai_moves": self.ai_moves,
+      "timeouts": self.timeouts,
+      "ai_errors": self.ai_errors,
+      "queue_depth": self.queue_depth,
+      "queue_waiting": self.queue_waiting,
+      "peak_queue_depth": self.peak_queue_depth,
+      "latency_p50_ms": percentile(latencies, 0.5),
+      "latency_p99_ms": percentile(latencies, 0.99),
+      "latency_max_ms": max(latencies, default=0.0),
+      "uptime_s": time.perf_counter() - self.started
+    }
+
+class AIPool:
+  # ai_service.calculate_best_move in worker processes with at most
+  # max_queue moves submitted at a time. Further moves wait for room, so a
+  # burst of sessions slows down their own answers instead of piling work
+  # onto the pool.
+  def __init__(self, metrics, workers=None, max_queue=None, tablebase_path=None, book_path=None):
+    self.workers = workers or os.cpu_count() or 1
+    # Workers are started on demand, a forked worker would hold on to the
+    # client sockets open at that time and keep them from closing
+    if "forkserver" in multiprocessing.get_all_start_methods():
+      self.context = multiprocessing.get_context("forkserver")
+    else:
+      self.context = worker_context()
+    self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self.context)
+    self.slots = asyncio.Semaphore(max_queue or self.workers * 2)
+    self.metrics = metrics
+    self.tablebase_path = tablebase_path
+    self.book_path = book_path
+
+  # (PieceType, Vector2) of the AI for the active player, raises
+  # asyncio.TimeoutError when it isn't there within timeout seconds and
+  # AIError when the worker failed
+  async def best_move(self, game, ai_options, timeout):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    metrics = self.metrics
+
+    metrics.queue_waiting += 1
+    try:
+      await asyncio.wait_for(self.slots.acquire(), timeout)
+    finally:
+      metrics.queue_waiting -= 1
+
+    metrics.queue_depth += 1
+    metrics.peak_queue_depth = max(metrics.peak_queue_depth, metrics.queue_depth)
+    try:
+      future = self.submit(game, ai_options)
+    except BaseException:
+      self.release()
+      raise
+    # The slot is freed when the worker is done, a move that timed out while
+    # running still occupies its worker until then
+    future.add_done_callback(lambda x: self.done(loop))
+
+    try:
+      return await asyncio.wait_for(asyncio.wrap_future(future), max(0.0, deadline - loop.time()))
+    except asyncio.TimeoutError:
+      raise
+    except BrokenProcessPool as error:
+      raise AIError("the AI worker stopped") from error
+    except Exception as error:
+      raise AIError(f"the AI failed: {error!r}") from error
+
+  # Submits to a new executor when a worker died and broke the current one,
+  # every move submitted to the broken one fails
+  def submit(self, game, ai_options):
+    args = (calculate_best_move, game.to_bytes(), ai_options, self.tablebase_path, "ai", self.book_path)
+    try:
+      return self.executor.submit(*args)
+    except BrokenProcessPool:
+      pass
+    self.executor.shutdown(wait=False, cancel_futures=True)
+    self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self.context)
+    try:
+      return self.executor.submit(*args)
+    except BrokenProcessPool as error:
+      raise AIError("the AI workers can't be started") from error
+
+  # Runs in the thread that finished the future
+  def done(self, loop):
+    if not loop.is_closed():
+      loop.call_soon_threadsafe(self.release)
+
+  def release(self):
+    self.metrics.queue_depth -= 1
+    self.slots.release()
+
+  def shutdown(self):
+    self.executor.shutdown(wait=False, cancel_futures=True)
+
+class Session:
+  def __init__(self, id, ai_player, ai_options, timeout):
+    self.id = id
+    self.game = Game()
+    # Player index the AI plays, None when the client plays both
+    self.ai_player = ai_player
+    self.ai_options = ai_options
+    self.timeout = timeout
+
+  @property
+  def finished(self):
+    return self.game.winner is not None or self.game.in_stale_mate
+
+class Server:
+  def __init__(self, pool, metrics, depth=2, max_depth=4, timeout=10.0, max_sessions=10000):
+    self.pool = pool
+    self.metrics = metrics
+    self.depth = depth
+    self.max_depth = max_depth
+    self.timeout = timeout
+    self.max_sessions = max_sessions
+    self.session_ids = itertools.count(1)
+    # Open client connections
+    self.connections = 0
+
+  async def handle_connection(self, reader, writer):
+    sessions = {}
+    self.connections += 1
+    try:
+      while True:
+        try:
+          line = await reader.readline()
+        except (ConnectionError, ValueError):
+          break
+        if not line:
+          break
+        if not line.strip():
+          continue
+
+        response = await self.handle_line(line, sessions)
+        writer.write(json.dumps(response).encode() + b"\n")
+        # Waits while the client isn't reading its answers
+        await writer.drain()
+    except ConnectionError:
+      pass
+    finally:
+      self.connections -= 1
+      self.metrics.sessions -= len(sessions)
+      writer.close()
+
+  async def handle_line(self, line, sessions):
+    request_id = None
+    try:
+      try:
+        request = json.loads(line)
+      except ValueError:
+        raise ProtocolError("request is not JSON")
+      if not isinstance(request, dict):
+        raise ProtocolError("request is not a JSON object")
+      request_id = request.get("id")
+
+      handler = getattr(self, f"op_{request.get('op')}", None)
+      if handler is None:
+        raise ProtocolError(f"unknown op {request.get('op')}")
+      response = await handler(request, sessions)
+    except ProtocolError as error:
+      return {"id": request_id, "ok": False, "error": str(error)}
+    except asyncio.TimeoutError:
+      self.metrics.timeouts += 1
+      return {"id": request_id, "ok": False, "error": "timeout"}
+    except AIError as error:
+      self.metrics.ai_errors += 1
+      return {"id": request_id, "ok": False, "error": str(error)}
+    except Exception:
+      # A bug in a handler fails its request, not the connection with every
+      # session on it
+      traceback.print_exc()
+      return {"id": request_id, "ok": False, "error": "internal error"}
+
+    return {"id": request_id, "ok": True, **response}
+
+  def session(self, request, sessions):
+    session_id = request.get("session")
+    if not isinstance(session_id, int) or isinstance(session_id, bool):
+      raise ProtocolError(f"session is a session id, not {session_id}")
+    session = sessions.get(session_id)
+    if session is None:
+      raise ProtocolError(f"no session {session_id}")
+    return session
+
+  async def op_new(self, request, sessions):
+    if self.metrics.sessions >= self.max_sessions:
+      raise ProtocolError("too many sessions")
+
+    ai_color = request.get("ai")
+    if ai_color is not None and ai_color not in COLORS:
+      raise ProtocolError(f"ai is one of {', '.join(COLORS)} or null")
+    depth = request.get("depth", self.depth)
+    if not isinstance(depth, int) or isinstance(depth, bool) or not 0 < depth <= self.max_depth:
+      raise ProtocolError(f"depth is between 1 and {self.max_depth}")
+    timeout = request.get("timeout", self.timeout)
+    if not isinstance(timeout, (int, float)) or isinstance(timeout, bool) or not 0 < timeout <= self.timeout:
+      raise ProtocolError(f"timeout is at most {self.timeout} seconds")
+
+    ai_player = COLORS.index(ai_color) if ai_color is not None else None
+    session = Session(next(self.session_ids), ai_player, {"depth": depth}, timeout)
+    response = {"session": session.id}
+    # The session only exists once the AI made its opening move, a client
+    # whose new failed has nothing to retry or close
+    if ai_player == session.game.board.turn:
+      response["ai_move"] = await self.ai_move(session)
+    sessions[session.id] = session
+    self.metrics.sessions += 1
+    self.metrics.sessions_opened += 1
+
+    response["state"] = game_state(session.game)
+    return response
+
+  async def op_move(self, request, sessions):
+    session = self.session(request, sessions)
+    game = session.game
+    if session.finished:
+      raise ProtocolError("the game is over")
+    if session.ai_player == game.board.turn:
+      raise ProtocolError("the AI is to move")
+
+    piece_type, position = decode_move(request.get("move"))
+    played = len(game.moves)
+    game.set_position(game.active_player.get_piece(piece_type), position)
+    if len(game.moves) == played:
+      raise ProtocolError(f"{request.get('move')} is not a legal move")
+    self.metrics.moves += 1
+
+    response = {}
+    if not session.finished and session.ai_player == game.board.turn:
+      response["ai_move"] = await self.ai_move(session)
+    response["state"] = game_state(game)
+    return response
+
+  # Asks for the AI move again, after a timeout, or plays the active player
+  # with the AI in a session without one
+  async def op_ai(self, request, sessions):
+    session = self.session(request, sessions)
+    if session.finished:
+      raise ProtocolError("the game is over")
+    return {"ai_move": await self.ai_move(session), "state": game_state(session.game)}
+
+  async def op_state(self, request, sessions):
+    return {"state": game_state(self.session(request, sessions).game)}
+
+  async def op_close(self, request, sessions):
+    session = self.session(request, sessions)
+    del sessions[session.id]
+    self.metrics.sessions -= 1
+    return {}
+
+  async def op_metrics(self, request, sessions):
+    return {"metrics": self.metrics.as_dict()}
+
+  async def ai_move(self, session):
+    start = time.perf_counter()
+    move = await self.pool.best_move(session.game, session.ai_options, session.timeout)
+    self.metrics.latencies_ms.append((time.perf_counter() - start) * 1000)
+    self.metrics.ai_moves += 1
+
+    game = session.game
+    game.set_position(game.active_player.get_piece(move[0]), move[1])
+    return encode_move(move)
+
+# Starts listening on a Unix socket when unix_path is set, else on host and
+# port. Port 0 picks a free one, see server.sockets.
+async def start(server, host="127.0.0.1", port=DEFAULT_PORT, unix_path=None):
+  if unix_path is not None:
+    return await asyncio.start_unix_server(server.handle_connection, path=unix_path)
+  return await asyncio.start_server(server.handle_connection, host, port)
+
+async def serve(args):
+  metrics = Metrics()
+  pool = AIPool(metrics, args.workers, args.queue, args.tablebase, args.book)
+  server = Server(pool, metrics, args.depth, args.max_depth, args.timeout, args.max_sessions)
+  listener = await start(server, args.host, args.port, args.unix)
+  for sock in listener.sockets:
+    print(f"Listening on {sock.getsockname()}", file=sys.stderr)
+  try:
+    async with listener:
+      await listener.serve_forever()
+  finally:
+    pool.shutdown()
+
+def main():
+  parser = argparse.ArgumentParser(description="Host Quantik games against the AI for many clients, one JSON request per line")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+  parser.add_argument("--unix", help="listen on this Unix socket instead of TCP")
+  parser.add_argument("--workers", type=int, help="AI processes, the number of CPUs by default")
+  parser.add_argument("--queue", type=int, help="AI moves submitted to the workers at a time, twice the workers by default")
+  parser.add_argument("--depth", type=int, default=2, help="search depth of sessions that don't pick one")
+  parser.add_argument("--max-depth", type=int, default=4, choices=range(1, MAX_DEPTH + 1), metavar=f"1-{MAX_DEPTH}")
+  parser.add_argument("--timeout", type=float, default=10.0, help="seconds an AI move may take, sessions can pick less")
+  parser.add_argument("--max-sessions", type=int, default=10000)
+  parser.add_argument("--tablebase", default=TABLEBASE_PATH)
+  parser.add_argument("--book", default=BOOK_PATH)
+  args = parser.parse_args()
+
+  try:
+    asyncio.run(serve(args))
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == "__main__":
+  sys.exit(main())
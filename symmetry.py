@@ -0,0 +1,122 @@
+from collections import namedtuple
+from board import Board, SHAPE_COUNT, SQUARE_COUNT, ZOBRIST_PIECES, ZOBRIST_TURN, square_index, square_position
+
+# Orders of the rows (or columns) that keep both halves of the quadrants
+# together: swapping the halves and swapping within each half
+LINE_ORDERS = (
+  (0, 1, 2, 3), (1, 0, 2, 3), (0, 1, 3, 2), (1, 0, 3, 2),
+  (2, 3, 0, 1), (3, 2, 0, 1), (2, 3, 1, 0), (3, 2, 1, 0)
+)
+
+def _square_permutation(rows, columns, transpose):
+  permutation = [0] * SQUARE_COUNT
+  for square in range(SQUARE_COUNT):
+    x, y = square_position(square)
+    if transpose:
+      permutation[square] = square_index(rows[y], columns[x])
+    else:
+      permutation[square] = square_index(columns[x], rows[y])
+  return tuple(permutation)
+
+# Every rotation, reflection and row/column swap that maps rows, columns and
+# quadrants onto rows, columns and quadrants. The first one is the identity.
+SQUARE_PERMUTATIONS = tuple(
+  _square_permutation(rows, columns, transpose)
+  for transpose in (False, True) for rows in LINE_ORDERS for columns in LINE_ORDERS
+)
+
+# OCCUPANCY_TABLES[permutation][nibble][bits] -> permuted mask of 4 squares
+OCCUPANCY_TABLES = tuple(
+  tuple(
+    tuple(sum(1 << permutation[nibble * 4 + bit] for bit in range(4) if bits & (1 << bit)) for bits in range(16))
+    for nibble in range(4)
+  )
+  for permutation in SQUARE_PERMUTATIONS
+)
+
+# squares[square] and shapes[shape] give the square and shape in the transformed position
+Transform = namedtuple("Transform", ["squares", "shapes"])
+
+def transform_move(move, transform):
+  shape, square = move
+  return transform.shapes[shape], transform.squares[square]
+
+def untransform_move(move, transform):
+  shape, square = move
+  return transform.shapes.index(shape), transform.squares.index(square)
+
+def transform_board(board, transform):
+  transformed = Board()
+  for player in range(2):
+    for shape, mask in enumerate(board.pieces[player]):
+      for square in range(SQUARE_COUNT):
+        if mask & (1 << square):
+          transformed.place(player, transform.shapes[shape], transform.squares[square])
+  transformed.set_turn(board.turn)
+  return transformed
+
+# Maps the board onto the representative of all its symmetric positions.
+# Returns the transform from the board to that representative.
+def canonical_transform(board):
+  occupied = board.occupied
+  low, mid_low, mid_high, high = occupied & 0xF, (occupied >> 4) & 0xF, (occupied >> 8) & 0xF, occupied >> 12
+
+  # The representative has the smallest occupancy mask...
+  best_occupancy = None
+  candidates = []
+  for index, tables in enumerate(OCCUPANCY_TABLES):
+    permuted = tables[0][low] | tables[1][mid_low] | tables[2][mid_high] | tables[3][high]
+    if best_occupancy is None or permuted < best_occupancy:
+      best_occupancy = permuted
+      candidates = [index]
+    elif permuted == best_occupancy:
+      candidates.append(index)
+
+  pieces = []
+  for player in range(2):
+    for shape, mask in enumerate(board.pieces[player]):
+      if mask:
+        for square in range(SQUARE_COUNT):
+          if mask & (1 << square):
+            pieces.append((square, player, shape))
+
+  # ...and among those the smallest pieces in square order, with the shapes
+  # renamed in order of appearance
+  best_codes = None
+  best_transform = None
+  for index in candidates:
+    permutation = SQUARE_PERMUTATIONS[index]
+    shapes = [None] * SHAPE_COUNT
+    next_shape = 0
+    codes = []
+    for square, player, shape in sorted((permutation[square], player, shape) for square, player, shape in pieces):
+      if shapes[shape] is None:
+        shapes[shape] = next_shape
+        next_shape += 1
+      codes.append(shapes[shape] * 2 + player)
+
+    if best_codes is None or codes < best_codes:
+      for shape in range(SHAPE_COUNT):
+        if shapes[shape] is None:
+          shapes[shape] = next_shape
+          next_shape += 1
+      best_codes = codes
+      best_transform = Transform(permutation, tuple(shapes))
+
+  return best_transform
+
+def canonicalize(board):
+  transform = canonical_transform(board)
+  return transform_board(board, transform).encode(), transform
+
+# Zobrist key of the canonical position, shared by all symmetric positions
+def canonical_key(board):
+  transform = canonical_transform(board)
+  key = ZOBRIST_TURN if board.turn else 0
+  for player in range(2):
+    for shape, mask in enumerate(board.pieces[player]):
+      if mask:
+        for square in range(SQUARE_COUNT):
+          if mask & (1 << square):
+            key ^= ZOBRIST_PIECES[player][transform.shapes[shape]][transform.squares[square]]
+  return key, transform
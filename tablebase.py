@@ -0,0 +1,157 @@
+import argparse
+import hashlib
+import mmap
+import struct
+import sys
+import time
+from board import Board
+from symmetry import canonicalize
+
+# Result of a position for the player to move
+WIN = 1
+LOSS = 2
+DRAW = 3
+
+DEFAULT_PATH = "quantik.tb"
+
+MAGIC = b"QKTB"
+VERSION = 1
+# magic, version, log2 of the slot count, number of positions
+HEADER = struct.Struct("<4sHHI")
+# squares of the canonical encoding, player to move, result << 4 | distance (0 for an empty slot)
+RECORD = struct.Struct("<QBB")
+
+SQUARES_MASK = (1 << 64) - 1
+
+def _slot(squares, turn, slot_bits):
+  return (((squares * 0x9E3779B97F4A7C15) ^ turn) & SQUARES_MASK) >> (64 - slot_bits)
+
+def _rank(value):
+  result, distance = value
+  if result == WIN:
+    return (2, -distance)
+  if result == DRAW:
+    return (1, -distance)
+  return (0, distance)
+
+# Value of a position reached by a move, for the player who made it
+def _after_move(value):
+  result, distance = value
+  if result == WIN:
+    return LOSS, distance + 1
+  if result == LOSS:
+    return WIN, distance + 1
+  return DRAW, distance + 1
+
+# Solves every position reachable from the start of the game, keyed by
+# canonical encoding. Values are (result, distance to the end of the game)
+# for the player to move: the fastest win, the slowest loss or the fastest
+# draw. Positions won by the previous move aren't included.
+def solve():
+  values = {}
+
+  def solve_position(board):
+    encoding = canonicalize(board)[0]
+    value = values.get(encoding)
+    if value is not None:
+      return value
+
+    turn = board.turn
+    best = None
+    for shape, square in board.legal_moves():
+      if board.winning_line(shape, square):
+        candidate = (WIN, 1)
+      else:
+        board.place(turn, shape, square)
+        candidate = _after_move(solve_position(board))
+        board.remove(turn, shape, square)
+
+      if best is None or _rank(candidate) > _rank(best):
+        best = candidate
+
+    # No legal moves is a stale mate
+    if best is None:
+      best = (DRAW, 0)
+
+    values[encoding] = best
+    return best
+
+  solve_position(Board())
+  return values
+
+def write(values, path):
+  slot_bits = 1
+  while (1 << slot_bits) < 2 * len(values):
+    slot_bits += 1
+  slot_count = 1 << slot_bits
+
+  slots = [None] * slot_count
+  # Sorted insertion keeps the file byte for byte reproducible
+  for encoding in sorted(values):
+    squares, turn = encoding & SQUARES_MASK, encoding >> 64
+    slot = _slot(squares, turn, slot_bits)
+    while slots[slot] is not None:
+      slot = (slot + 1) & (slot_count - 1)
+    slots[slot] = (squares, turn, values[encoding])
+
+  with open(path, "wb") as outfile:
+    outfile.write(HEADER.pack(MAGIC, VERSION, slot_bits, len(values)))
+    for record in slots:
+      if record is None:
+        outfile.write(RECORD.pack(0, 0, 0))
+      else:
+        squares, turn, (result, distance) = record
+        outfile.write(RECORD.pack(squares, turn, result << 4 | distance))
+
+class Tablebase:
+  # Only the header is read up front, records are paged in by the lookups
+  def __init__(self, path=DEFAULT_PATH):
+    self.file = open(path, "rb")
+    self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, self.slot_bits, self.count = HEADER.unpack_from(self.data, 0)
+    if magic != MAGIC or version != VERSION:
+      raise Exception(f"{path} is not a version {VERSION} Quantik tablebase")
+    self.slot_count = 1 << self.slot_bits
+
+  def close(self):
+    self.data.close()
+    self.file.close()
+
+  def __len__(self):
+    return self.count
+
+  # (result, distance) for the player to move, None for positions that
+  # can't be reached from the start of the game
+  def lookup_encoding(self, encoding):
+    squares, turn = encoding & SQUARES_MASK, encoding >> 64
+    slot = _slot(squares, turn, self.slot_bits)
+    while True:
+      record_squares, record_turn, value = RECORD.unpack_from(self.data, HEADER.size + slot * RECORD.size)
+      if value == 0:
+        return None
+      if record_squares == squares and record_turn == turn:
+        return value >> 4, value & 0xF
+      slot = (slot + 1) & (self.slot_count - 1)
+
+  def lookup(self, board):
+    return self.lookup_encoding(canonicalize(board)[0])
+
+def main():
+  parser = argparse.ArgumentParser(description="Solve Quantik and write the endgame tablebase")
+  parser.add_argument("--output", default=DEFAULT_PATH)
+  args = parser.parse_args()
+
+  start = time.time()
+  values = solve()
+  write(values, args.output)
+
+  with open(args.output, "rb") as infile:
+    checksum = hashlib.sha256(infile.read()).hexdigest()
+  result = Tablebase(args.output).lookup(Board())[0]
+  result_name = {WIN: "win", LOSS: "loss", DRAW: "draw"}[result]
+  print(f"Solved {len(values)} positions in {time.time() - start:.1f}s, the first player can force a {result_name}")
+  print(f"{args.output} sha256 {checksum}")
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,74 @@
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+
+class TranspositionTable:
+  # Entries live in buckets of two slots: the first keeps the deepest search
+  # of the positions mapping to it, the second is overwritten on every store.
+  # Memory is capped at max_entries entries.
+  def __init__(self, max_entries=1 << 16):
+    bucket_count = 1
+    while bucket_count * 4 <= max_entries:
+      bucket_count *= 2
+
+    self.mask = bucket_count - 1
+    self.depth_preferred = [None] * bucket_count
+    self.always_replace = [None] * bucket_count
+
+    self.hits = 0
+    self.misses = 0
+    self.collisions = 0
+
+  @property
+  def max_entries(self):
+    return 2 * len(self.depth_preferred)
+
+  def __len__(self):
+    return sum(1 for entry in self.depth_preferred if entry is not None) + sum(1 for entry in self.always_replace if entry is not None)
+
+  def clear(self):
+    bucket_count = len(self.depth_preferred)
+    self.depth_preferred = [None] * bucket_count
+    self.always_replace = [None] * bucket_count
+    self.hits = 0
+    self.misses = 0
+    self.collisions = 0
+
+  # Returns the (depth, bound, score, move) stored for the key, or None
+  def probe(self, key):
+    index = key & self.mask
+
+    entry = self.depth_preferred[index]
+    if entry is not None and entry[0] == key:
+      self.hits += 1
+      return entry[1:]
+
+    other = self.always_replace[index]
+    if other is not None and other[0] == key:
+      self.hits += 1
+      return other[1:]
+
+    self.misses += 1
+    if entry is not None or other is not None:
+      self.collisions += 1
+    return None
+
+  def store(self, key, depth, bound, score, move):
+    index = key & self.mask
+    entry = (key, depth, bound, score, move)
+
+    current = self.depth_preferred[index]
+    if current is None or current[0] == key or depth >= current[1]:
+      self.depth_preferred[index] = entry
+    else:
+      self.always_replace[index] = entry
+
+  @property
+  def stats(self):
+    return {
+      "entries": len(self),
+      "max_entries": self.max_entries,
+      "hits": self.hits,
+      "misses": self.misses,
+      "collisions": self.collisions
+    }
@@ -1,9 +1,23 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
-@dataclass
+# Positions are values: frozen so they can be dict and set keys, compared by
+# x and y. The board squares are interned in quantik.SQUARE_VECTORS with
+# their square index, other vectors (mouse positions) have none.
+@dataclass(frozen=True, slots=True)
 class Vector2:
   x: int
   y: int
+  square: int = field(default=None, compare=False, repr=False)
+
+  def __eq__(self, other):
+    if self is other:
+      return True
+    if other.__class__ is not Vector2:
+      return NotImplemented
+    return self.x == other.x and self.y == other.y
+
+  def __hash__(self):
+    return hash((self.x, self.y))
 
 def flatten(list):
-  return [item for sublist in list for item in sublist]
\ No newline at end of file
+  return [item for sublist in list for item in sublist]